@@ -41,7 +41,7 @@ from database import (  # type: ignore
     set_waiting, get_waiting_users,
     daily_rehabilitation, PERMANENT_PREMIUM_USERS,
     set_premium_expiry, is_premium_active, get_premium_expiry,
-    adjust_rating, add_report, add_rating_log
+    record_rating, add_report, apply_rating_events, compact_rating_log,
 )
 
 # ==== опциональные dev-роутеры и команды ====
@@ -63,6 +63,8 @@ if router_dev:
     dp.include_router(router_dev)
 
 REHAB_INTERVAL = 24 * 3600  # 24 часа
+RATING_APPLY_INTERVAL = float(os.getenv("RATING_APPLY_INTERVAL", "2"))  # сек.: события рейтинга → users.rating
+RATING_COMPACT_INTERVAL = 3600
 
 # ===================== ЛОКАЛИЗАЦИЯ =====================
 def tr(lang: str, key: str) -> str:
@@ -981,8 +983,10 @@ def rating_keyboard(target_id: int, lang: str):
 async def rate_up(callback: types.CallbackQuery):
     rater = callback.from_user.id
     target = int(callback.data.split("_")[-1])
-    await add_rating_log(rater, target)
-    await adjust_rating(target, +3)
+    # оценка — событие; повторный клик по той же клавиатуре (тот же message_id) не учитывается
+    if not await record_rating(rater, target, +3, chat_key=callback.message.message_id):
+        await callback.answer("OK")
+        return
     try:
         await callback.message.edit_reply_markup(None)
     except Exception:
@@ -995,8 +999,9 @@ async def rate_up(callback: types.CallbackQuery):
 async def rate_down(callback: types.CallbackQuery):
     rater = callback.from_user.id
     target = int(callback.data.split("_")[-1])
-    await add_rating_log(rater, target)
-    await adjust_rating(target, -5)
+    if not await record_rating(rater, target, -5, chat_key=callback.message.message_id):
+        await callback.answer("OK")
+        return
     try:
         await callback.message.edit_reply_markup(None)
     except Exception:
@@ -1026,8 +1031,11 @@ async def process_report(callback: types.CallbackQuery):
     rater = callback.from_user.id
     target = int(target)
     reasons = {"fake": "Fake/Gender mismatch", "spam": "Spam/Ads", "scam": "Scam/Fraud"}
-    await add_report(target, rater, reasons.get(reason, "Other"), penalty=15)
-    await adjust_rating(target, -15)
+    # штраф -15 входит в событие жалобы; adjust_rating сверху списал бы его дважды
+    if not await add_report(target, rater, reasons.get(reason, "Other"), penalty=15,
+                            chat_key=callback.message.message_id):
+        await callback.answer("OK")
+        return
     try:
         await callback.message.edit_reply_markup(None)
     except Exception:
@@ -1047,6 +1055,24 @@ async def start_rehabilitation_loop():
         await asyncio.sleep(REHAB_INTERVAL)
 
 
+# ===================== ПРИМЕНЕНИЕ РЕЙТИНГА =====================
+async def start_rating_loop():
+    # оценки и жалобы пишутся событиями в rating_log; в users.rating их переносит этот цикл
+    last_compact = time.monotonic()
+    while True:
+        try:
+            while await apply_rating_events():
+                pass
+            if time.monotonic() - last_compact > RATING_COMPACT_INTERVAL:
+                last_compact = time.monotonic()
+                removed = await compact_rating_log()
+                if removed:
+                    logging.info("rating_log: compacted %s events", removed)
+        except Exception:
+            logging.exception("rating apply error")
+        await asyncio.sleep(RATING_APPLY_INTERVAL)
+
+
 # ===================== ГЛОБАЛЬНЫЙ ПЕРЕХВАТ ОШИБОК =====================
 @dp.error()
 async def _errors_handler(event: ErrorEvent):
@@ -1213,6 +1239,7 @@ async def main():
 
     # Ежедневная реабилитация
     asyncio.create_task(start_rehabilitation_loop())
+    asyncio.create_task(start_rating_loop())
 
     # Веб-морда статистики + авто-открытие вкладки
     if os.getenv("START_STATS", "1") == "1":
@@ -1,5 +1,6 @@
 # database.py — PostgreSQL only, asyncpg + pool, RU/EN Neverland
 import os
+import time
 import asyncio
 import logging
 from typing import Optional, List, Tuple, Any, Dict
@@ -7,6 +8,8 @@ from datetime import datetime, timedelta
 
 import asyncpg
 
+from ttl_cache import TTLCache
+
 # ==========================
 # Конфиг подключения к PG
 # ==========================
@@ -19,6 +22,10 @@ PG_POOL_MIN = int(os.getenv("PG_POOL_MIN", "1"))
 PG_POOL_MAX = int(os.getenv("PG_POOL_MAX", "10"))
 PG_TIMEOUT  = float(os.getenv("PG_TIMEOUT", "10"))
 
+# Кэш профилей (get_user): сколько секунд живёт запись и сколько записей держим
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "30"))
+USER_CACHE_MAX = int(os.getenv("USER_CACHE_MAX", "10000"))
+
 # Премиум «навсегда» (друзья) — через env-список ID
 # пример: PERMANENT_PREMIUM_IDS="111,222,333"
 _PERMA_ENV = os.getenv("PERMANENT_PREMIUM_IDS", "").strip()
@@ -66,6 +73,7 @@ CREATE TABLE IF NOT EXISTS users (
     rating          INTEGER NOT NULL DEFAULT 0,
     premium_until   TIMESTAMPTZ NULL,       -- премиум до даты
     waiting         BOOLEAN NOT NULL DEFAULT FALSE,
+    search_gender   TEXT NULL,              -- фильтр пола текущего поиска (для возобновления)
     vibe            TEXT NOT NULL DEFAULT '',  -- 'funny','calm',...
     premium_forever BOOLEAN NOT NULL DEFAULT FALSE, -- доп. флаг
     created_at      TIMESTAMPTZ NOT NULL DEFAULT now(),
@@ -81,11 +89,15 @@ CREATE TABLE IF NOT EXISTS reports (
     created_at TIMESTAMPTZ NOT NULL DEFAULT now()
 );
 
+-- события рейтинга (append-only): оценки и жалобы; в users.rating их сносит apply_rating_events()
 CREATE TABLE IF NOT EXISTS rating_log (
     id         BIGSERIAL PRIMARY KEY,
     rater      BIGINT NOT NULL,
     target     BIGINT NOT NULL,
     delta      INTEGER NOT NULL DEFAULT 0,
+    kind       TEXT NOT NULL DEFAULT 'vote',   -- 'vote' (👍/👎) / 'report'
+    chat_key   BIGINT NULL,                    -- ключ идемпотентности: одно событие на (rater, target, chat, kind)
+    applied    BOOLEAN NOT NULL DEFAULT FALSE,
     created_at TIMESTAMPTZ NOT NULL DEFAULT now()
 );
 
@@ -97,6 +109,32 @@ CREATE TABLE IF NOT EXISTS pairs (
     created_at TIMESTAMPTZ NOT NULL DEFAULT now()
 );
 
+-- активные диалоги: строка на каждого участника (владелец строки — шард этого user_id)
+CREATE TABLE IF NOT EXISTS chats (
+    user_id    BIGINT PRIMARY KEY,
+    partner_id BIGINT NOT NULL,
+    started_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+-- состояния FSM aiogram (регистрация, смена настроек); key — из KeyBuilder
+CREATE TABLE IF NOT EXISTS fsm_states (
+    key        TEXT PRIMARY KEY,
+    state      TEXT NULL,
+    data       JSONB NOT NULL DEFAULT '{}'::jsonb,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+CREATE INDEX IF NOT EXISTS idx_fsm_updated ON fsm_states (updated_at);
+
+-- старые базы: колонка появилась позже
+ALTER TABLE users ADD COLUMN IF NOT EXISTS search_gender TEXT NULL;
+ALTER TABLE rating_log ADD COLUMN IF NOT EXISTS kind TEXT NOT NULL DEFAULT 'vote';
+ALTER TABLE rating_log ADD COLUMN IF NOT EXISTS chat_key BIGINT NULL;
+-- старые записи уже учтены прямыми UPDATE — помечаем их применёнными, новые по умолчанию нет
+ALTER TABLE rating_log ADD COLUMN IF NOT EXISTS applied BOOLEAN NOT NULL DEFAULT TRUE;
+ALTER TABLE rating_log ALTER COLUMN applied SET DEFAULT FALSE;
+CREATE UNIQUE INDEX IF NOT EXISTS uq_rating_event ON rating_log (rater, target, chat_key, kind) WHERE chat_key IS NOT NULL;
+CREATE INDEX IF NOT EXISTS idx_rating_pending ON rating_log (id) WHERE NOT applied;
+
 -- индексы под быстрый поиск
 CREATE INDEX IF NOT EXISTS idx_users_waiting ON users (waiting);
 CREATE INDEX IF NOT EXISTS idx_users_lang    ON users (language);
@@ -104,6 +142,7 @@ CREATE INDEX IF NOT EXISTS idx_users_gender  ON users (gender);
 CREATE INDEX IF NOT EXISTS idx_users_age     ON users (age);
 CREATE INDEX IF NOT EXISTS idx_users_rating  ON users (rating);
 CREATE INDEX IF NOT EXISTS idx_users_vibe    ON users (vibe);
+CREATE INDEX IF NOT EXISTS idx_pairs_created ON pairs (created_at);
 """
 
 TRIGGER_SQL = """
@@ -158,13 +197,30 @@ FROM users
 WHERE user_id = $1
 """
 
+# кортежи USER_SELECT; любая запись в users через этот модуль вызывает invalidate_user(),
+# поэтому TTL нужен только против правок мимо модуля (другой процесс, ручной SQL)
+_user_cache: TTLCache[Tuple[Any, ...]] = TTLCache(USER_CACHE_TTL, USER_CACHE_MAX)
+
+def invalidate_user(user_id: Optional[int] = None) -> None:
+    """Сбросить профиль из кэша (None — весь кэш)."""
+    _user_cache.invalidate(user_id)
+
+def user_cache_stats() -> Dict[str, Any]:
+    return _user_cache.stats()
+
 async def get_user(user_id: int) -> Optional[Tuple[Any, ...]]:
+    cached = _user_cache.get(user_id)
+    if cached is not None:
+        return cached
+    epoch = _user_cache.epoch
     pool = await _ensure_pool()
     async with pool.acquire() as con:
         row = await con.fetchrow(USER_SELECT, user_id)
         if not row:
             return None
-        return tuple(row)
+        row = tuple(row)
+    _user_cache.put(user_id, row, epoch)
+    return row
 
 async def save_user(user_id: int, gender: str, age: int, language: str) -> None:
     pool = await _ensure_pool()
@@ -180,6 +236,7 @@ async def save_user(user_id: int, gender: str, age: int, language: str) -> None:
             """,
             user_id, gender, age, language
         )
+    invalidate_user(user_id)
 
 async def update_user(
     user_id: int,
@@ -209,14 +266,16 @@ async def update_user(
     pool = await _ensure_pool()
     async with pool.acquire() as con:
         await con.execute(sql, *args)
+    invalidate_user(user_id)
 
-async def set_waiting(user_id: int, flag: int | bool) -> None:
+async def set_waiting(user_id: int, flag: int | bool, gender_filter: Optional[str] = None) -> None:
     pool = await _ensure_pool()
     async with pool.acquire() as con:
         await con.execute(
-            "UPDATE users SET waiting = $1 WHERE user_id = $2",
-            bool(flag), user_id
+            "UPDATE users SET waiting = $1, search_gender = $2 WHERE user_id = $3",
+            bool(flag), (gender_filter if flag else None), user_id
         )
+    invalidate_user(user_id)
 
 async def get_waiting_users(
     *,
@@ -250,6 +309,109 @@ async def get_waiting_users(
         rows = await con.fetch(sql, *params)
         return [(r["user_id"],) for r in rows]
 
+# ==========================
+# Активные диалоги (общие для всех шардов)
+# ==========================
+async def chat_open(user_id: int, partner_id: int) -> None:
+    """Записать сторону user_id диалога; пара логируется в pairs один раз (со стороны меньшего id)."""
+    pool = await _ensure_pool()
+    async with pool.acquire() as con:
+        async with con.transaction():
+            await con.execute(
+                """
+                INSERT INTO chats (user_id, partner_id) VALUES ($1, $2)
+                ON CONFLICT (user_id) DO UPDATE SET partner_id = EXCLUDED.partner_id, started_at = now()
+                """,
+                user_id, partner_id
+            )
+            if user_id < partner_id:
+                await con.execute("INSERT INTO pairs (user_a, user_b) VALUES ($1, $2)", user_id, partner_id)
+
+async def chat_close(user_id: int) -> Optional[int]:
+    """Удалить сторону user_id; возвращает partner_id, если диалог был."""
+    pool = await _ensure_pool()
+    async with pool.acquire() as con:
+        return await con.fetchval("DELETE FROM chats WHERE user_id = $1 RETURNING partner_id", user_id)
+
+async def load_sessions(shard: int = 0, shards: int = 1) -> Dict[str, Any]:
+    """
+    Состояние пользователей шарда после рестарта — двумя запросами на всё, без запроса на сессию:
+      active:   {user_id: partner_id} — диалоги, у которых есть обе стороны;
+      orphaned: [user_id] — сторона без пары (процесс упал посреди закрытия), строки удалены;
+      searching:[(user_id, row, search_gender)] — прерванные поиски, row в формате USER_SELECT.
+    """
+    pool = await _ensure_pool()
+    async with pool.acquire() as con:
+        async with con.transaction():
+            chats = await con.fetch(
+                """
+                SELECT c.user_id, c.partner_id, (p.user_id IS NOT NULL) AS mutual
+                FROM chats c
+                LEFT JOIN chats p ON p.user_id = c.partner_id AND p.partner_id = c.user_id
+                WHERE c.user_id % $2 = $1
+                """,
+                shard, shards
+            )
+            orphaned = [r["user_id"] for r in chats if not r["mutual"]]
+            if orphaned:
+                await con.execute("DELETE FROM chats WHERE user_id = ANY($1::bigint[])", orphaned)
+            searching = await con.fetch(
+                """
+                SELECT u.user_id, u.search_gender,
+                       u.gender, u.age, u.language, '' AS reserved, u.interests, u.rating,
+                       EXTRACT(EPOCH FROM u.premium_until)::BIGINT AS premium_until_epoch, u.waiting, u.vibe
+                FROM users u
+                WHERE u.waiting AND u.user_id % $2 = $1
+                  AND NOT EXISTS (SELECT 1 FROM chats c WHERE c.user_id = u.user_id)
+                """,
+                shard, shards
+            )
+    return {
+        "active": {r["user_id"]: r["partner_id"] for r in chats if r["mutual"]},
+        "orphaned": orphaned,
+        "searching": [(r["user_id"], tuple(r)[2:], r["search_gender"]) for r in searching],
+    }
+
+# ==========================
+# FSM (см. fsm_storage.PGStorage)
+# ==========================
+async def fsm_load(key: str, ttl_secs: float) -> Optional[Tuple[Optional[str], str]]:
+    """(state, data_json) если запись есть и не старше ttl_secs."""
+    pool = await _ensure_pool()
+    async with pool.acquire() as con:
+        row = await con.fetchrow(
+            "SELECT state, data::text AS data FROM fsm_states "
+            "WHERE key = $1 AND updated_at > now() - make_interval(secs => $2)",
+            key, float(ttl_secs)
+        )
+        return (row["state"], row["data"]) if row else None
+
+async def fsm_save_batch(upserts: List[Tuple[str, Optional[str], str]], deletes: List[str]) -> None:
+    """Пакетная запись: upserts — (key, state, data_json), deletes — ключи пустых состояний."""
+    pool = await _ensure_pool()
+    async with pool.acquire() as con:
+        async with con.transaction():
+            if upserts:
+                await con.executemany(
+                    """
+                    INSERT INTO fsm_states (key, state, data, updated_at) VALUES ($1, $2, $3::jsonb, now())
+                    ON CONFLICT (key) DO UPDATE
+                    SET state = EXCLUDED.state, data = EXCLUDED.data, updated_at = now()
+                    """,
+                    upserts
+                )
+            if deletes:
+                await con.execute("DELETE FROM fsm_states WHERE key = ANY($1::text[])", deletes)
+
+async def fsm_expire(ttl_secs: float) -> int:
+    """Удалить брошенные состояния; возвращает сколько удалено."""
+    pool = await _ensure_pool()
+    async with pool.acquire() as con:
+        status = await con.execute(
+            "DELETE FROM fsm_states WHERE updated_at < now() - make_interval(secs => $1)", float(ttl_secs)
+        )
+        return int(status.split()[-1])
+
 # ==========================
 # Premium
 # ==========================
@@ -265,6 +427,7 @@ async def set_premium_expiry(user_id: int, months: int) -> None:
             "UPDATE users SET premium_until = $1 WHERE user_id = $2",
             dt, user_id
         )
+    invalidate_user(user_id)
 
 async def get_premium_expiry(user_id: int) -> Optional[int]:
     pool = await _ensure_pool()
@@ -275,6 +438,18 @@ async def get_premium_expiry(user_id: int) -> Optional[int]:
         )
         return int(row["ts"]) if row and row["ts"] is not None else None
 
+async def get_premium_state(user_id: int) -> Tuple[bool, Optional[int]]:
+    """(premium_forever, premium_until_epoch) одним запросом; (False, None) если юзера нет."""
+    pool = await _ensure_pool()
+    async with pool.acquire() as con:
+        row = await con.fetchrow(
+            "SELECT premium_forever, EXTRACT(EPOCH FROM premium_until)::BIGINT AS ts FROM users WHERE user_id = $1",
+            user_id
+        )
+        if not row:
+            return False, None
+        return bool(row["premium_forever"]), (int(row["ts"]) if row["ts"] is not None else None)
+
 async def is_premium_active(user_id: int) -> bool:
     if user_id in PERMANENT_PREMIUM_USERS:
         return True
@@ -301,31 +476,97 @@ async def adjust_rating(user_id: int, delta: int) -> None:
             """,
             delta, user_id
         )
+    invalidate_user(user_id)
 
 async def add_rating_log(rater: int, target: int, delta: int = 0) -> None:
+    """
+    Только запись в журнал (старый контракт: рейтинг меняли отдельным adjust_rating).
+    applied = TRUE — apply_rating_events её не применит; для оценок есть record_rating.
+    """
     pool = await _ensure_pool()
     async with pool.acquire() as con:
         await con.execute(
-            "INSERT INTO rating_log (rater, target, delta) VALUES ($1, $2, $3)",
+            "INSERT INTO rating_log (rater, target, delta, applied) VALUES ($1, $2, $3, TRUE)",
             rater, target, delta
         )
 
-async def add_report(target: int, rater: int, reason: str, penalty: int = 15) -> None:
+RATING_EVENT_SQL = """
+INSERT INTO rating_log (rater, target, delta, kind, chat_key) VALUES ($1, $2, $3, $4, $5)
+ON CONFLICT (rater, target, chat_key, kind) WHERE chat_key IS NOT NULL DO NOTHING
+RETURNING id
+"""
+
+async def record_rating(rater: int, target: int, delta: int, *, chat_key: Optional[int] = None) -> bool:
+    """
+    Записать оценку как событие; users.rating не трогаем (см. apply_rating_events).
+    False — такая оценка в этом чате уже была (повторный клик).
+    """
+    pool = await _ensure_pool()
+    async with pool.acquire() as con:
+        return await con.fetchval(RATING_EVENT_SQL, rater, target, delta, "vote", chat_key) is not None
+
+async def add_report(target: int, rater: int, reason: str, penalty: int = 15, *, chat_key: Optional[int] = None) -> bool:
+    """
+    Жалоба + событие рейтинга -penalty одной транзакцией. Штраф применяет apply_rating_events,
+    отдельно adjust_rating звать не нужно. False — жалоба в этом чате уже была.
+    """
     pool = await _ensure_pool()
     async with pool.acquire() as con:
         async with con.transaction():
+            if await con.fetchval(RATING_EVENT_SQL, rater, target, -penalty, "report", chat_key) is None:
+                return False
             await con.execute(
                 "INSERT INTO reports (target, rater, reason, penalty) VALUES ($1, $2, $3, $4)",
                 target, rater, reason, penalty
             )
+    return True
+
+async def apply_rating_events(limit: int = 5000) -> int:
+    """
+    Применить пачку неприменённых событий: суммы по target, одна строка users на цель за пачку.
+    Возвращает число применённых событий. SKIP LOCKED — второй применяющий не ждёт первого.
+    Ограничение [-100, 100] накладывается на сумму пачки, а не на каждое событие.
+    """
+    pool = await _ensure_pool()
+    async with pool.acquire() as con:
+        async with con.transaction():
+            rows = await con.fetch(
+                """
+                UPDATE rating_log SET applied = TRUE
+                WHERE id IN (
+                    SELECT id FROM rating_log WHERE NOT applied ORDER BY id LIMIT $1 FOR UPDATE SKIP LOCKED
+                )
+                RETURNING target, delta
+                """,
+                limit
+            )
+            if not rows:
+                return 0
+            sums: Dict[int, int] = {}
+            for r in rows:
+                sums[r["target"]] = sums.get(r["target"], 0) + r["delta"]
+            targets = [t for t, d in sums.items() if d]
             await con.execute(
                 """
-                UPDATE users
-                SET rating = GREATEST(-100, rating - $1)
-                WHERE user_id = $2
+                UPDATE users u
+                SET rating = GREATEST(-100, LEAST(100, u.rating + s.delta))
+                FROM unnest($1::bigint[], $2::int[]) AS s(target, delta)
+                WHERE u.user_id = s.target
                 """,
-                penalty, target
+                targets, [sums[t] for t in targets]
             )
+    for t in targets:
+        invalidate_user(t)
+    return len(rows)
+
+async def compact_rating_log(keep_days: int = 30) -> int:
+    """Удалить применённые события старше keep_days (ключи идемпотентности дольше не нужны)."""
+    pool = await _ensure_pool()
+    async with pool.acquire() as con:
+        status = await con.execute(
+            "DELETE FROM rating_log WHERE applied AND created_at < now() - make_interval(days => $1)", keep_days
+        )
+        return int(status.split()[-1])
 
 # ==========================
 # Реабилитация (раз в сутки)
@@ -339,53 +580,53 @@ async def daily_rehabilitation() -> None:
         await con.execute(
             "UPDATE users SET rating = LEAST(50, rating + 1) WHERE rating < 50"
         )
+    invalidate_user()
 
 # ==========================
 # Статистика для вебморды
 # ==========================
+STATS_USERS_SQL = """
+SELECT GROUPING(language, vibe) AS g, language, vibe,
+       COUNT(*)                                         AS total,
+       COUNT(*) FILTER (WHERE gender = 'male')          AS male,
+       COUNT(*) FILTER (WHERE gender = 'female')        AS female,
+       COUNT(*) FILTER (WHERE premium_forever OR (premium_until IS NOT NULL AND premium_until > now())) AS premium,
+       COUNT(*) FILTER (WHERE waiting)                  AS waiting
+FROM users
+GROUP BY GROUPING SETS ((), (language), (vibe))
+"""
+
+STATS_PAIRS_SQL = """
+SELECT (SELECT COUNT(*) FROM pairs)                                              AS pairs_total,
+       (SELECT COUNT(*) FROM pairs WHERE created_at >= date_trunc('day', now())) AS matches_today,
+       (SELECT COUNT(*) FROM chats) / 2                                          AS active_chats
+"""
+
 async def get_stats() -> Dict[str, Any]:
     """
-    Аккуратная версия: использует пул, не создаёт одиночных соединений.
+    Один проход по users: счётчики через FILTER, разбивки по языку и вайбу через GROUPING SETS;
+    пары и активные диалоги — вторым коротким запросом (pairs.created_at под индексом).
     Возвращает {"ok": True, "data": {...}} либо кидает исключение
-    (которое перехватит FastAPI и вернёт 503).
+    (которое перехватит FastAPI и вернёт 503). Часто не зовите — см. stats_api.StatsSnapshot.
     """
     pool = await _ensure_pool()
     async with pool.acquire() as con:
-        data: Dict[str, Any] = {}
-
-        # пользователи
-        row = await con.fetchrow("SELECT COUNT(*) AS c FROM users;")
-        data["users_total"] = int(row["c"]) if row else 0
-
-        row = await con.fetchrow("SELECT COUNT(*) AS c FROM users WHERE gender='male';")
-        data["users_male"] = int(row["c"]) if row else 0
-
-        row = await con.fetchrow("SELECT COUNT(*) AS c FROM users WHERE gender='female';")
-        data["users_female"] = int(row["c"]) if row else 0
-
-        # премиум
-        row = await con.fetchrow(
-            "SELECT COUNT(*) AS c FROM users WHERE premium_forever OR (premium_until IS NOT NULL AND premium_until > now());"
-        )
-        data["premium_users"] = int(row["c"]) if row else 0
-
-        # в очереди
-        row = await con.fetchrow("SELECT COUNT(*) AS c FROM users WHERE waiting = TRUE;")
-        data["waiting_now"] = int(row["c"]) if row else 0
-
-        # пары (если таблица используется)
-        try:
-            row = await con.fetchrow("SELECT COUNT(*) AS c FROM pairs;")
-            data["pairs_total"] = int(row["c"]) if row else 0
-        except Exception:
-            data["pairs_total"] = 0
-
-        # распределение по языкам
-        rows = await con.fetch("SELECT language, COUNT(*) AS c FROM users GROUP BY language;")
-        data["by_language"] = {r["language"]: int(r["c"]) for r in rows}
-
-        # распределение по вайбу
-        rows = await con.fetch("SELECT vibe, COUNT(*) AS c FROM users WHERE vibe <> '' GROUP BY vibe;")
-        data["by_vibe"] = {r["vibe"]: int(r["c"]) for r in rows}
-
-        return {"ok": True, "data": data}
+        rows = await con.fetch(STATS_USERS_SQL)
+        extra = await con.fetchrow(STATS_PAIRS_SQL)
+
+    data: Dict[str, Any] = {
+        "users_total": 0, "users_male": 0, "users_female": 0, "premium_users": 0, "waiting_now": 0,
+        "by_language": {}, "by_vibe": {},
+    }
+    for r in rows:
+        if r["g"] == 3:     # итог по всем
+            data.update(users_total=int(r["total"]), users_male=int(r["male"]), users_female=int(r["female"]),
+                        premium_users=int(r["premium"]), waiting_now=int(r["waiting"]))
+        elif r["g"] == 1:   # по языку
+            data["by_language"][r["language"]] = int(r["total"])
+        elif r["vibe"]:     # по вайбу, пустой не считаем
+            data["by_vibe"][r["vibe"]] = int(r["total"])
+    data["pairs_total"] = int(extra["pairs_total"])
+    data["matches_today"] = int(extra["matches_today"])
+    data["active_chats"] = int(extra["active_chats"])
+    return {"ok": True, "data": data}
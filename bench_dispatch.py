@@ -0,0 +1,88 @@
+# bench_dispatch.py — cost of routing one message through the reply-button filters
+# Usage: python bench_dispatch.py [N]
+# legacy: lambda m: m.text in {tr("ru", k), tr("en", k)} with tr() rebuilding its tables per call
+# current: ButtonMiddleware resolves the button once, Button(...) filters compare a key
+import asyncio
+import sys
+import time
+from datetime import datetime
+
+from aiogram import Bot, Dispatcher
+from aiogram.types import Chat, Message, Update, User
+
+import i18n
+from i18n import Button, ButtonMiddleware, tr
+
+# те же кнопки и в том же порядке, что и хендлеры в bot_2.py
+HANDLER_KEYS = [
+    ("btn_back",), ("btn_profile",), ("btn_about",), ("btn_settings",), ("btn_set_age",),
+    ("btn_set_gender",), ("btn_set_lang",), ("btn_set_vibe",), ("btn_set_interests",),
+    ("btn_premium",), ("btn_random",), ("btn_find_boy", "btn_find_girl"),
+    ("btn_stop_search",), ("btn_restart_chat",), ("btn_end_chat",),
+]
+
+
+def _legacy_tr(lang: str, key: str) -> str:
+    # как было: словарь собирался заново при каждом вызове
+    L = {lg: dict(table) for lg, table in i18n._SOURCE.items()}
+    lang = "en" if lang == "en" else "ru"
+    return L[lang].get(key, L["ru"].get(key, key))
+
+
+async def _noop(message: Message):
+    return None
+
+
+def build_legacy() -> Dispatcher:
+    dp = Dispatcher()
+    for keys in HANDLER_KEYS:
+        dp.message.register(_noop, lambda m, keys=keys: m.text in {_legacy_tr(lg, k) for k in keys for lg in i18n.LANGS})
+    dp.message.register(_noop)  # relay_any: всё остальное
+    return dp
+
+
+def build_current() -> Dispatcher:
+    dp = Dispatcher()
+    dp.message.outer_middleware(ButtonMiddleware())
+    for keys in HANDLER_KEYS:
+        dp.message.register(_noop, Button(*keys))
+    dp.message.register(_noop)
+    return dp
+
+
+def make_updates() -> list[Update]:
+    user = User(id=1, is_bot=False, first_name="u")
+    chat = Chat(id=1, type="private")
+    texts = [tr(lg, k) for keys in HANDLER_KEYS for k in keys for lg in i18n.LANGS]
+    texts += ["привет", "how are you?", "ok"] * 5  # обычные сообщения в чате проходят все фильтры
+    return [
+        Update(update_id=i, message=Message(message_id=i, date=datetime.now(), chat=chat, from_user=user, text=t))
+        for i, t in enumerate(texts)
+    ]
+
+
+async def bench(name: str, dp: Dispatcher, bot: Bot, updates: list[Update], n: int) -> float:
+    for u in updates:  # прогрев
+        await dp.feed_update(bot, u)
+    t0 = time.perf_counter()
+    for _ in range(n):
+        for u in updates:
+            await dp.feed_update(bot, u)
+    per = (time.perf_counter() - t0) / (n * len(updates)) * 1e6
+    print(f"{name:<8} {per:8.1f} µs/update")
+    return per
+
+
+async def main(n: int):
+    bot = Bot(token="123456:TEST")
+    updates = make_updates()
+    try:
+        legacy = await bench("legacy", build_legacy(), bot, updates, n)
+        current = await bench("current", build_current(), bot, updates, n)
+        print(f"speedup  {legacy / current:8.1f}x  ({len(updates)} updates x {n})")
+    finally:
+        await bot.session.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 200))
@@ -0,0 +1,64 @@
+# bench_matchmaker.py — cost of one Matchmaker tick (match_pending) as the waiting pool grows
+# Usage: python bench_matchmaker.py [max_queue]
+# stuck: everyone filters for a gender nobody in the pool has, so nobody can be paired
+#        and the tick only probes buckets (the worst case for the relaxed pass)
+# mixed: random profiles, most of the pool gets paired in the tick
+# The tick visits every waiting user once, so its cost per user must stay flat;
+# exits with code 1 if it grows more than MAX_GROWTH times between the smallest and largest pool.
+import asyncio
+import random
+import sys
+import time
+
+from matchmaker import SearchTicket, Matchmaker
+
+LANGS = ("ru", "en", "uk", "de")
+VIBES = ("", "", "chill", "flirt", "talk")
+MAX_GROWTH = 3.0
+
+
+def ticket(uid: int, rnd: random.Random, *, stuck: bool, old: float) -> SearchTicket:
+    if stuck:
+        gender, wants = "m", "f"
+    else:
+        gender = rnd.choice(("m", "f"))
+        wants = rnd.choice((None, None, "m", "f"))
+    return SearchTicket(
+        user_id=uid, language=rnd.choice(LANGS), age=rnd.randint(16, 45), gender=gender,
+        vibe=rnd.choice(VIBES), gender_filter=wants, enqueued_at=old,
+    )
+
+
+async def tick_cost(n: int, *, stuck: bool) -> tuple[float, int]:
+    rnd = random.Random(n)
+
+    async def on_match(uid: int, pid: int) -> None:
+        pass
+
+    mm = Matchmaker(on_match, relax_after=0.0)
+    old = time.monotonic() - 60
+    for uid in range(1, n + 1):
+        mm._waiting.add(ticket(uid, rnd, stuck=stuck, old=old))
+    t0 = time.perf_counter()
+    made = await mm.match_pending()
+    return time.perf_counter() - t0, made
+
+
+async def main(max_queue: int) -> int:
+    sizes = [n for n in (500, 1_000, 2_000, 4_000, 8_000, 16_000) if n <= max_queue]
+    failed = False
+    for scenario in ("stuck", "mixed"):
+        per_user = []
+        for n in sizes:
+            cost, made = await tick_cost(n, stuck=scenario == "stuck")
+            per_user.append(cost / n)
+            print(f"{scenario:5}  queue={n:>6}  tick={cost * 1000:8.2f} ms  per user={cost / n * 1e6:6.2f} us  pairs={made}")
+        growth = max(per_user) / min(per_user)
+        if growth > MAX_GROWTH:
+            print(f"FAIL: {scenario} per-user tick cost grew {growth:.1f}x")
+            failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 16_000)))
@@ -0,0 +1,72 @@
+# bench_sender.py — relay throughput against a rate-limited fake Bot API
+# Usage: python bench_sender.py [chats] [messages_per_chat]
+# direct:    every send goes straight to bot.send_message; on 429 sleep retry_after and try again
+# scheduler: sends go through sender.SendScheduler configured with the same limits
+# Limits are scaled x10 (300 msg/s global, 10 msg/s per chat) to keep the run short.
+import asyncio
+import logging
+import sys
+import time
+
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.exceptions import TelegramRetryAfter
+
+from fake_telegram import FakeBotAPI
+from sender import RELAY, SendScheduler
+
+GLOBAL_RATE = 300
+CHAT_RATE = 10
+
+
+async def direct(bot: Bot, chats: int, per_chat: int) -> None:
+    async def one(chat_id: int, i: int):
+        while True:
+            try:
+                return await bot.send_message(chat_id, f"m{i}")
+            except TelegramRetryAfter as e:
+                await asyncio.sleep(e.retry_after)
+
+    await asyncio.gather(*(one(c, i) for c in range(1, chats + 1) for i in range(per_chat)))
+
+
+async def scheduled(bot: Bot, chats: int, per_chat: int) -> dict:
+    s = SendScheduler(global_rate=GLOBAL_RATE, global_burst=GLOBAL_RATE / 30, chat_rate=CHAT_RATE, chat_burst=1)
+    runner = s.start()
+    try:
+        await asyncio.gather(*(
+            s.send(c, lambda c=c, i=i: bot.send_message(c, f"m{i}"), priority=RELAY)
+            for c in range(1, chats + 1) for i in range(per_chat)
+        ))
+    finally:
+        runner.cancel()
+    return s.stats()
+
+
+async def run(name: str, fn, chats: int, per_chat: int) -> None:
+    api = FakeBotAPI(global_rate=GLOBAL_RATE, chat_rate=CHAT_RATE)
+    base = await api.start(port=8083)
+    bot = Bot("123456:FAKE", session=AiohttpSession(api=TelegramAPIServer.from_base(base)))
+    try:
+        t0 = time.perf_counter()
+        extra = await fn(bot, chats, per_chat)
+        dt = time.perf_counter() - t0
+        total = chats * per_chat
+        print(f"{name:<9} {total} msgs in {dt:5.2f}s -> {total / dt:6.1f} msg/s (ceiling {GLOBAL_RATE}), 429s={api.flood_waits}")
+        if extra:
+            print(f"          {extra}")
+    finally:
+        await bot.session.close()
+        await api.stop()
+
+
+async def main(chats: int, per_chat: int) -> None:
+    logging.getLogger("sender").setLevel(logging.ERROR)  # flood-wait warnings are what we count here
+    await run("direct", direct, chats, per_chat)
+    await run("scheduler", scheduled, chats, per_chat)
+
+
+if __name__ == "__main__":
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 100,
+                     int(sys.argv[2]) if len(sys.argv) > 2 else 20))
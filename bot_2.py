@@ -2,17 +2,19 @@
 import asyncio
 import logging
 import os
-import random
 import re
+import time
 from datetime import datetime
+from functools import lru_cache
 
 from aiogram import Bot, Dispatcher, F, types
 from aiogram.client.default import DefaultBotProperties
-from aiogram.exceptions import TelegramForbiddenError
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError
 from aiogram.filters import Command, CommandStart
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.types import (
     InlineKeyboardButton, InlineKeyboardMarkup,
     KeyboardButton, ReplyKeyboardMarkup, LabeledPrice, PreCheckoutQuery
@@ -31,12 +33,38 @@ if not TOKEN:
 # ==== импорт БД API ====
 from database import (  # type: ignore
     init_db, get_user, save_user, update_user,
-    set_waiting, get_waiting_users,
-    daily_rehabilitation, PERMANENT_PREMIUM_USERS,
-    set_premium_expiry, is_premium_active, get_premium_expiry,
-    adjust_rating, add_report, add_rating_log,
+    set_waiting,
+    daily_rehabilitation,
+    set_premium_expiry,
+    record_rating, add_report, apply_rating_events, compact_rating_log,
+    chat_open, chat_close, load_sessions,
+    user_cache_stats,
 )
 
+# ==== FSM в PG (кэш в памяти, пакетная запись) ====
+from fsm_storage import PGStorage
+
+# ==== премиум-статус (кэш в памяти) ====
+from entitlements import entitlements
+
+# ==== подбор пар (в памяти процесса) ====
+from matchmaker import Matchmaker, SearchTicket
+
+# ==== шарды: BOT_SHARDS процессов, каждый владеет своей частью user_id ====
+from shards import cluster
+
+# ==== приём апдейтов: polling или вебхук (BOT_MODE) ====
+from webhook import BOT_MODE, run_webhook
+
+# ==== исходящие сообщения: лимиты Telegram, RetryAfter, приоритеты ====
+from sender import GLOBAL_BURST, GLOBAL_RATE, NOTICE, RELAY, REPLY, sender
+
+# ==== живые счётчики для вебморды и /metrics ====
+from metrics import metrics
+
+# ==== пересылка альбомов одним запросом ====
+from relay import MediaGroupBuffer
+
 # ==== вебморда статистики ====
 try:
     from stats_api import start_stats_server  # type: ignore
@@ -51,227 +79,25 @@ except Exception:
 
 # ===================== ЛОГИ, БОТ =====================
 logging.basicConfig(level=logging.INFO, format="%(levelname)s:%(name)s:%(message)s")
-bot = Bot(token=TOKEN, default=DefaultBotProperties(parse_mode="HTML"))
-dp = Dispatcher(storage=MemoryStorage())
+# TELEGRAM_API — свой Bot API сервер (или fake_telegram.py для локальных прогонов)
+_TELEGRAM_API = os.getenv("TELEGRAM_API", "")
+bot = Bot(
+    token=TOKEN,
+    default=DefaultBotProperties(parse_mode="HTML"),
+    session=AiohttpSession(api=TelegramAPIServer.from_base(_TELEGRAM_API)) if _TELEGRAM_API else None,
+)
+fsm_storage = PGStorage()
+dp = Dispatcher(storage=fsm_storage)
 
 REHAB_INTERVAL = 24 * 3600  # 24 часа
+RATING_APPLY_INTERVAL = float(os.getenv("RATING_APPLY_INTERVAL", "2"))  # сек.: события рейтинга → users.rating
+RATING_COMPACT_INTERVAL = 3600
 
 # ===================== ЛОКАЛИЗАЦИЯ =====================
-def tr(lang: str, key: str) -> str:
-    L = {
-        "ru": {
-            # Кнопки главного меню
-            "btn_random": "🎯 Случайный собеседник",
-            "btn_find_girl": "👩 Поиск девушки",
-            "btn_find_boy": "👨 Поиск парня",
-            "btn_settings": "⚙ Настройки",
-            "btn_profile": "👁 Профиль",
-            "btn_about": "🌌 О Neverland",
-            "btn_premium": "💎 Premium",
-            # Кнопки состояний
-            "btn_stop_search": "⛔ Остановить поиск",
-            "btn_end_chat": "🚫 Завершить диалог",
-            "btn_restart_chat": "🔄 Завершить и искать нового",
-            "btn_back": "🔙 Назад",
-            # Кнопки настроек
-            "btn_set_age": "✏️ Сменить возраст",
-            "btn_set_gender": "🚻 Сменить пол",
-            "btn_set_lang": "🌐 Сменить язык",
-            "btn_set_vibe": "✨ Сменить вайб",
-            "btn_set_interests": "🎯 Сменить интересы",
-
-            # Регистрация/общие
-            "welcome": "💫 Добро пожаловать в <b>Neverland Chat</b> — давай настроим профиль.",
-            "ask_gender": "Выбери пол:",
-            "gender_male": "Парень",
-            "gender_female": "Девушка",
-            "ask_age": "📅 Введи возраст (13–100):",
-            "err_age": "Возраст должен быть от 13 до 100. Попробуй ещё раз:",
-            "ask_lang": "Выбери язык:",
-            "lang_ru": "Русский",
-            "lang_en": "English",
-
-            # Меню/профиль/правила/о проекте
-            "menu_title": "💬 Главное меню:",
-            "settings_title": "⚙️ Настройки профиля:",
-            "profile_title": "👤 <b>Твой профиль</b>",
-            "rules": (
-                "📜 <b>Правила Neverland Chat</b>\n\n"
-                "1. Уважай анонимность — не раскрывай личные данные.\n"
-                "2. Не отправляй личные фото без согласия.\n"
-                "3. Без оскорблений, спама и рекламы.\n"
-                "4. Контент 18+ запрещён.\n"
-                "5. Нарушения снижают карму и могут привести к бану."
-            ),
-            "about": (
-                "🌌 <b>Neverland Chat</b> — анонимный уют среди звёзд.\n"
-                "Без масок и лишних соцсетей — только живой разговор с незнакомцем на одной волне.\n\n"
-                "<b>Почему здесь классно</b>\n"
-                "• 🎯 Умный подбор по вайбу и интересам\n"
-                "• 💬 Чистый диалог — один приватный чат\n"
-                "• 🌟 Карма и защита от абуза\n"
-                "• ⏳ Честное ожидание\n\n"
-                "💫 <i>Neverland — место, где легко быть собой и находить тёплые диалоги.</i>"
-            ),
-
-            # Профиль
-            "id_line": "🪪 Твой Telegram ID: <code>{id}</code>",
-            "gender_line": "Пол: <b>{gender}</b>",
-            "age_line": "Возраст: <b>{age}</b>",
-            "lang_line": "Язык: <b>{lang}</b>",
-            "vibe_line": "Вайб: <b>{vibe}</b>",
-            "interests_line": "Интересы: <b>{interests}</b>",
-            "rating_line": "Карма: <b>{rating}</b> 🌟",
-            "premium_status": "Статус: {status}",
-            "premium_forever": "💎 Premium (навсегда)",
-            "premium_until": "💎 Premium (до {date})",
-            "premium_free": "🆓 Базовый",
-
-            # Поиск/чат
-            "search_started": "🌠 Начинаем поиск собеседника...\n\n{gender_pref}{vibe}\n{interests}\n\nИщем того, кто на одной волне с тобой 💫",
-            "pref_gender": "Предпочтение по полу: <b>{gender}</b>\n",
-            "chat_found": "🌟 <b>Собеседник найден!</b>\n\n🪄 Команды:\n/stop — завершить диалог\n/restart — завершить и искать нового",
-            "already_searching": "🔍 Уже идёт поиск или ты в чате.",
-            "search_stopped": "🛑 Поиск остановлен.",
-            "no_active_chat": "❗ У тебя нет активного диалога.",
-            "partner_left": "😔 Собеседник покинул чат.",
-            "chat_ended": "💬 Диалог завершён.",
-            "unsupported": "📎 Получен неподдерживаемый тип сообщения.",
-            "chat_partner_left": "😔 Собеседник завершил диалог.",
-
-            # Настройки/сохранение
-            "ask_new_age": "📅 Введи новый возраст (13–100):",
-            "age_saved": "✅ Возраст обновлён: {age}",
-            "gender_saved": "✅ Пол обновлён.",
-            "ask_new_lang": "Выбери язык:",
-            "lang_saved": "✅ Язык обновлён.",
-            "choose_vibe": "💫 Выбери свой вайб:",
-            "choose_interests": "🎯 Выбери интересы (нажатие — сразу сохраняет):",
-            "vibe_reset": "🔄 Вайб сброшен.",
-            "interests_reset": "🔄 Все интересы очищены.",
-            "interest_add": "{key} — добавлено",
-            "interest_remove": "{key} — убрано",
-
-            # Premium
-            "premium_text": (
-                "💎 <b>Neverland Premium</b>\n\n"
-                "✨ Что даёт Premium:\n"
-                "• Поиск по полу (👩 / 👨)\n"
-                "• Без ограничений на количество чатов\n"
-                "• Приоритет в поиске и выдаче\n"
-                "• Маленький значок 💎 в профиле\n\n"
-                "Оплата через Telegram Stars ⭐"
-            ),
-            "premium_only": "💎 <b>Эта функция доступна только Premium-пользователям.</b>",
-            "premium_activated": "💎 Premium активирован на {months} мес!",
-        },
-        "en": {
-            # Buttons
-            "btn_random": "🎯 Random match",
-            "btn_find_girl": "👩 Find a girl",
-            "btn_find_boy": "👨 Find a boy",
-            "btn_settings": "⚙ Settings",
-            "btn_profile": "👁 Profile",
-            "btn_about": "🌌 About Neverland",
-            "btn_premium": "💎 Premium",
-            "btn_stop_search": "⛔ Stop searching",
-            "btn_end_chat": "🚫 End chat",
-            "btn_restart_chat": "🔄 End & find new",
-            "btn_back": "🔙 Back",
-            "btn_set_age": "✏️ Change age",
-            "btn_set_gender": "🚻 Change gender",
-            "btn_set_lang": "🌐 Change language",
-            "btn_set_vibe": "✨ Change vibe",
-            "btn_set_interests": "🎯 Change interests",
-
-            # Registration/general
-            "welcome": "💫 Welcome to <b>Neverland Chat</b> — let’s set up your profile.",
-            "ask_gender": "Choose your gender:",
-            "gender_male": "Boy",
-            "gender_female": "Girl",
-            "ask_age": "📅 Enter age (13–100):",
-            "err_age": "Age must be between 13 and 100. Try again:",
-            "ask_lang": "Choose language:",
-            "lang_ru": "Русский",
-            "lang_en": "English",
-
-            # Menu/profile/rules/about
-            "menu_title": "💬 Main menu:",
-            "settings_title": "⚙️ Profile settings:",
-            "profile_title": "👤 <b>Your profile</b>",
-            "rules": (
-                "📜 <b>Neverland Chat Rules</</b>\n\n"
-                "1. Respect anonymity — no personal data.\n"
-                "2. Don’t send personal photos without consent.\n"
-                "3. No insults, spam or ads.\n"
-                "4. 18+ content is not allowed.\n"
-                "5. Violations reduce karma and may lead to a ban."
-            ),
-            "about": (
-                "🌌 <b>Neverland Chat</b> — anonymous cozy space among stars.\n"
-                "No masks, no socials — just real talk with a like-minded stranger.\n\n"
-                "<b>Why it’s nice</b>\n"
-                "• 🎯 Smart matching via vibe & interests\n"
-                "• 💬 Single clean private dialog\n"
-                "• 🌟 Karma & abuse protection\n"
-                "• ⏳ Fair waiting\n\n"
-                "💫 <i>Neverland — a place to be yourself and find warm conversations.</i>"
-            ),
-
-            # Profile
-            "id_line": "🪪 Your Telegram ID: <code>{id}</code>",
-            "gender_line": "Gender: <b>{gender}</b>",
-            "age_line": "Age: <b>{age}</b>",
-            "lang_line": "Language: <b>{lang}</b>",
-            "vibe_line": "Vibe: <b>{vibe}</b>",
-            "interests_line": "Interests: <b>{interests}</b>",
-            "rating_line": "Karma: <b>{rating}</b> 🌟",
-            "premium_status": "Status: {status}",
-            "premium_forever": "💎 Premium (forever)",
-            "premium_until": "💎 Premium (till {date})",
-            "premium_free": "🆓 Free",
-
-            # Search/chat
-            "search_started": "🌠 Starting the search...\n\n{gender_pref}{vibe}\n{interests}\n\nLooking for someone on your wavelength 💫",
-            "pref_gender": "Gender preference: <b>{gender}</b>\n",
-            "chat_found": "🌟 <b>Match found!</b>\n\n🪄 Commands:\n/stop — end chat\n/restart — end & find new",
-            "already_searching": "🔍 You’re already searching or in a chat.",
-            "search_stopped": "🛑 Search stopped.",
-            "no_active_chat": "❗ You have no active dialog.",
-            "partner_left": "😔 Your partner left the chat.",
-            "chat_ended": "💬 Dialog ended.",
-            "unsupported": "📎 Unsupported message type.",
-            "chat_partner_left": "😔 Your partner ended the dialog.",
-
-            # Settings/saving
-            "ask_new_age": "📅 Enter new age (13–100):",
-            "age_saved": "✅ Age updated: {age}",
-            "gender_saved": "✅ Gender updated.",
-            "ask_new_lang": "Choose language:",
-            "lang_saved": "✅ Language updated.",
-            "choose_vibe": "💫 Choose your vibe:",
-            "choose_interests": "🎯 Choose interests (tap saves instantly):",
-            "vibe_reset": "🔄 Vibe cleared.",
-            "interests_reset": "🔄 Interests cleared.",
-            "interest_add": "{key} — added",
-            "interest_remove": "{key} — removed",
-
-            # Premium
-            "premium_text": (
-                "💎 <b>Neverland Premium</b>\n\n"
-                "✨ What you get:\n"
-                "• Gender search (👩 / 👨)\n"
-                "• No chat count limits\n"
-                "• Priority in queue & matching\n"
-                "• Small 💎 badge in profile\n\n"
-                "Payment via Telegram Stars ⭐"
-            ),
-            "premium_only": "💎 <b>This feature is for Premium users only.</b>",
-            "premium_activated": "💎 Premium activated for {months} mo!",
-        },
-    }
-    lang = "en" if lang == "en" else "ru"
-    return L[lang].get(key, L["ru"].get(key, key))
+# таблицы, tr() и обратная карта кнопок — в i18n.py
+from i18n import Button, ButtonMiddleware, tr
+
+dp.message.outer_middleware(ButtonMiddleware())
 
 
 def user_lang_from_row(row) -> str:
@@ -321,7 +147,18 @@ def vibe_and_interests_for(user_row) -> tuple[str, str]:
 
 
 # ===================== КЛАВИАТУРЫ =====================
+# Разметки — frozen pydantic-модели aiogram, поэтому одну и ту же можно отдавать во все send'ы.
+# Всё, что зависит только от (lang, состояние), собирается один раз и лежит в lru_cache.
+def _kb_lang(lang: str) -> str:
+    return "en" if lang == "en" else "ru"
+
+
 def kb_main(lang: str, searching=False, in_chat=False):
+    return _kb_main(_kb_lang(lang), bool(searching), bool(in_chat))
+
+
+@lru_cache(maxsize=None)
+def _kb_main(lang: str, searching: bool, in_chat: bool) -> ReplyKeyboardMarkup:
     t = lambda k: tr(lang, k)
     if searching:
         return ReplyKeyboardMarkup(
@@ -348,6 +185,11 @@ def kb_main(lang: str, searching=False, in_chat=False):
 
 
 def kb_settings(lang: str):
+    return _kb_settings(_kb_lang(lang))
+
+
+@lru_cache(maxsize=None)
+def _kb_settings(lang: str) -> ReplyKeyboardMarkup:
     t = lambda k: tr(lang, k)
     return ReplyKeyboardMarkup(
         keyboard=[
@@ -361,6 +203,11 @@ def kb_settings(lang: str):
 
 
 def kb_gender(lang: str):
+    return _kb_gender(_kb_lang(lang))
+
+
+@lru_cache(maxsize=None)
+def _kb_gender(lang: str) -> ReplyKeyboardMarkup:
     t = lambda k: tr(lang, k)
     return ReplyKeyboardMarkup(
         keyboard=[[KeyboardButton(text=t("gender_male")), KeyboardButton(text=t("gender_female"))]],
@@ -370,6 +217,11 @@ def kb_gender(lang: str):
 
 
 def kb_language_only_ru_en(lang: str):
+    return _kb_language_only_ru_en()
+
+
+@lru_cache(maxsize=1)
+def _kb_language_only_ru_en() -> ReplyKeyboardMarkup:
     return ReplyKeyboardMarkup(
         keyboard=[[KeyboardButton(text=tr("ru", "lang_ru")), KeyboardButton(text=tr("en", "lang_en"))]],
         resize_keyboard=True,
@@ -378,6 +230,13 @@ def kb_language_only_ru_en(lang: str):
 
 
 def kb_vibes_inline(lang: str, selected_key: str) -> InlineKeyboardMarkup:
+    lang = _kb_lang(lang)
+    # ключ, которого нет в VIBES_MAP, рисуется как «ничего не выбрано» — не плодим лишних записей
+    return _kb_vibes_inline(lang, selected_key if selected_key in VIBES_MAP[lang] else "")
+
+
+@lru_cache(maxsize=None)
+def _kb_vibes_inline(lang: str, selected_key: str) -> InlineKeyboardMarkup:
     items = []
     for key, label in VIBES_MAP[lang].items():
         prefix = "✅ " if key == selected_key else ""
@@ -388,11 +247,27 @@ def kb_vibes_inline(lang: str, selected_key: str) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=rows)
 
 
+# очищенные ключи интересов в порядке INTERESTS_MAP: бит i маски = INTERESTS_MAP[lang][i] выбран
+INTEREST_KEYS = {
+    lang: tuple(re.sub(r"[^\w\s]", "", it).strip().lower() for it in items)
+    for lang, items in INTERESTS_MAP.items()
+}
+
+
 def kb_interests_inline(lang: str, selected: set[str]) -> InlineKeyboardMarkup:
+    lang = _kb_lang(lang)
+    mask = 0
+    for i, clean in enumerate(INTEREST_KEYS[lang]):
+        if clean in selected:
+            mask |= 1 << i
+    return _kb_interests_inline(lang, mask)
+
+
+@lru_cache(maxsize=None)  # максимум 2 языка × 2^len(INTERESTS_MAP) масок
+def _kb_interests_inline(lang: str, mask: int) -> InlineKeyboardMarkup:
     items = []
-    for it in INTERESTS_MAP[lang]:
-        clean = re.sub(r"[^\w\s]", "", it).strip().lower()
-        prefix = "✅ " if clean in selected else ""
+    for i, (it, clean) in enumerate(zip(INTERESTS_MAP[lang], INTEREST_KEYS[lang])):
+        prefix = "✅ " if mask >> i & 1 else ""
         items.append(InlineKeyboardButton(text=f"{prefix}{it}", callback_data=f"interest_{clean}"))
     rows = [items[i:i + 2] for i in range(0, len(items), 2)]
     rows.append([InlineKeyboardButton(text=tr(lang, "interests_reset"), callback_data="interests_reset")])
@@ -401,6 +276,11 @@ def kb_interests_inline(lang: str, selected: set[str]) -> InlineKeyboardMarkup:
 
 
 def kb_premium_inline(lang: str):
+    return _kb_premium_inline()
+
+
+@lru_cache(maxsize=1)
+def _kb_premium_inline() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="💫 1 мес — 100⭐ / 1 mo — 100⭐", callback_data="buy_premium_1")],
         [InlineKeyboardButton(text="🌠 3 мес — 300⭐ / 3 mo — 300⭐", callback_data="buy_premium_3")],
@@ -409,9 +289,31 @@ def kb_premium_inline(lang: str):
 
 
 # ===================== ПАМЯТЬ В ОЗУ =====================
+# только пользователи этого шарда; диалоги дублируются в таблицу chats (chat_open/chat_close)
 active_chats: dict[int, int] = {}
 searching_users: set[int] = set()
-search_tasks: dict[int, asyncio.Task] = {}
+# один общий подборщик вместо поллинга на каждого юзера; on_chat_started объявлен ниже.
+# При BOT_SHARDS > 1 он работает только в координаторе, воркеры ходят к нему через cluster
+matchmaker = Matchmaker(on_match=lambda uid, pid: on_chat_started(uid, pid))
+cluster.bind(matchmaker)
+
+# ===================== МЕТРИКИ =====================
+# обновляются по событиям ниже; вебморда (stats_api) читает их без запросов в БД
+m_matches = metrics.counter("matches_total", "Pairs made by the matchmaker")
+m_matches_today = metrics.daily("matches_today", "Pairs made since local midnight")
+m_match_rate = metrics.rate("matches_per_minute", "Pairs made per minute, 5 min window", window=300, per=60)
+m_searches = metrics.counter("searches_started_total", "Searches started (incl. /next)")
+m_chats_ended = metrics.counter("chats_ended_total", "Chats ended by a user or by a block")
+m_relayed = metrics.counter("messages_relayed_total", "Messages copied to a partner")
+m_rating_events = metrics.counter("rating_events_applied_total", "Votes and reports applied to users.rating")
+m_relay_rate = metrics.rate("messages_relayed_per_second", "Messages copied to a partner per second, 10 s window", window=10)
+metrics.gauge("active_chats", "Chats in progress", fn=lambda: len(active_chats) / 2)
+metrics.gauge("searching_users", "Users waiting for a partner", fn=lambda: len(searching_users))
+metrics.gauge("send_queue", "Outgoing messages waiting in the scheduler", fn=lambda: sender.pending)
+metrics.counter("messages_sent_total", "Messages delivered by the scheduler", fn=lambda: sender.sent)
+metrics.counter("flood_waits_total", "RetryAfter answers from Telegram", fn=lambda: sender.retry_after)
+metrics.counter("user_cache_hits_total", "Profile cache hits", fn=lambda: user_cache_stats()["hits"])
+metrics.counter("user_cache_misses_total", "Profile cache misses", fn=lambda: user_cache_stats()["misses"])
 
 # ===================== FSM =====================
 class Reg(StatesGroup):
@@ -429,9 +331,7 @@ class Change(StatesGroup):
 # ===================== ХЕЛПЕРЫ ОТПРАВКИ/ОЧИСТКИ =====================
 async def _cleanup_blocked_user(uid: int):
     try:
-        task = search_tasks.pop(uid, None)
-        if task and not task.done():
-            task.cancel()
+        cluster.cancel(uid)
         searching_users.discard(uid)
         await set_waiting(uid, 0)
     except Exception:
@@ -439,20 +339,31 @@ async def _cleanup_blocked_user(uid: int):
     try:
         pid = active_chats.pop(uid, None)
         if pid:
-            active_chats.pop(pid, None)
-            row = await get_user(pid)
-            l = user_lang_from_row(row)
-            try:
-                await bot.send_message(pid, tr(l, "chat_partner_left"), reply_markup=kb_main(l))
-            except TelegramForbiddenError:
-                pass
+            m_chats_ended.inc()
+            await chat_close(uid)
+            await albums.flush_from(uid)
+            await cluster.call(pid, "partner_left", pid, "chat_partner_left")
     except Exception:
         logging.exception("cleanup: active chat cleanup failed")
 
 
+# выполняются на шарде, владеющем первым аргументом (см. shards.Cluster.call)
+@cluster.action("partner_left")
+async def _partner_left(pid: int, key: str):
+    if active_chats.pop(pid, None) is None:
+        return  # уже вышел сам / диалог закрыт с этой стороны
+    albums.drop_from(pid)  # недособранный альбом ушедшему собеседнику уже не нужен
+    await chat_close(pid)
+    l = user_lang_from_row(await get_user(pid))
+    try:
+        await sender.send(pid, lambda: bot.send_message(pid, tr(l, key), reply_markup=kb_main(l)), priority=NOTICE)
+    except TelegramForbiddenError:
+        pass
+
+
 async def safe_send_message(chat_id: int, text: str, **kw):
     try:
-        return await bot.send_message(chat_id, text, **kw)
+        return await sender.send(chat_id, lambda: bot.send_message(chat_id, text, **kw), priority=NOTICE)
     except TelegramForbiddenError:
         await _cleanup_blocked_user(chat_id)
         return None
@@ -460,7 +371,7 @@ async def safe_send_message(chat_id: int, text: str, **kw):
 
 async def safe_answer(message: types.Message, text: str, **kw):
     try:
-        return await message.answer(text, **kw)
+        return await sender.send(message.chat.id, lambda: message.answer(text, **kw), priority=REPLY)
     except TelegramForbiddenError:
         await _cleanup_blocked_user(message.chat.id)
         return None
@@ -483,7 +394,7 @@ async def start_cmd(message: types.Message, state: FSMContext):
 
 
 @dp.message(Command("menu"))
-@dp.message(lambda m: m.text in {tr("ru", "btn_back"), tr("en", "btn_back")})
+@dp.message(Button("btn_back"))
 async def show_menu(message: types.Message):
     user = await get_user(message.from_user.id)
     l = user_lang_from_row(user)
@@ -532,7 +443,7 @@ async def reg_lang(message: types.Message, state: FSMContext):
 
 # Профиль / О проекте / Правила / ID
 @dp.message(Command("profile"))
-@dp.message(lambda m: m.text in {tr("ru", "btn_profile"), tr("en", "btn_profile")})
+@dp.message(Button("btn_profile"))
 async def show_profile(message: types.Message):
     user = await get_user(message.from_user.id)
     if not (user and isinstance(user[1], int) and user[1] >= 13 and user[2]):
@@ -544,8 +455,9 @@ async def show_profile(message: types.Message):
     rating = user[5] if len(user) > 5 else 0
     vibe_disp, interests_disp = vibe_and_interests_for(user)
 
-    expiry_ts = await get_premium_expiry(message.from_user.id)
-    if message.from_user.id in PERMANENT_PREMIUM_USERS:
+    ent = await entitlements.get(message.from_user.id)
+    expiry_ts = ent.premium_until
+    if ent.forever:
         status = tr(l, "premium_forever")
     elif expiry_ts:
         status = tr(l, "premium_until").format(date=datetime.fromtimestamp(expiry_ts).strftime('%d.%m.%Y'))
@@ -567,7 +479,7 @@ async def show_profile(message: types.Message):
 
 
 @dp.message(Command("about"))
-@dp.message(lambda m: m.text in {tr("ru", "btn_about"), tr("en", "btn_about")})
+@dp.message(Button("btn_about"))
 async def about_project(message: types.Message):
     user = await get_user(message.from_user.id)
     l = user_lang_from_row(user)
@@ -588,14 +500,14 @@ async def show_id(message: types.Message):
 
 # ===================== НАСТРОЙКИ =====================
 @dp.message(Command("settings"))
-@dp.message(lambda m: m.text in {tr("ru","btn_settings"), tr("en","btn_settings")})
+@dp.message(Button("btn_settings"))
 async def settings_menu(message: types.Message):
     user = await get_user(message.from_user.id)
     l = user_lang_from_row(user)
     await safe_answer(message, tr(l, "settings_title"), reply_markup=kb_settings(l))
 
 
-@dp.message(lambda m: m.text in {tr("ru","btn_set_age"), tr("en","btn_set_age")})
+@dp.message(Button("btn_set_age"))
 async def ask_age(message: types.Message, state: FSMContext):
     user = await get_user(message.from_user.id)
     l = user_lang_from_row(user)
@@ -616,7 +528,7 @@ async def save_age(message: types.Message, state: FSMContext):
     await safe_answer(message, tr(l, "age_saved").format(age=age), reply_markup=kb_settings(l))
 
 
-@dp.message(lambda m: m.text in {tr("ru","btn_set_gender"), tr("en","btn_set_gender")})
+@dp.message(Button("btn_set_gender"))
 async def ask_gender_change(message: types.Message, state: FSMContext):
     user = await get_user(message.from_user.id)
     l = user_lang_from_row(user)
@@ -635,7 +547,7 @@ async def save_gender(message: types.Message, state: FSMContext):
     await safe_answer(message, tr(l, "gender_saved"), reply_markup=kb_settings(l))
 
 
-@dp.message(lambda m: m.text in {tr("ru","btn_set_lang"), tr("en","btn_set_lang")})
+@dp.message(Button("btn_set_lang"))
 async def ask_lang(message: types.Message, state: FSMContext):
     user = await get_user(message.from_user.id)
     l = user_lang_from_row(user)
@@ -658,7 +570,7 @@ async def save_lang(message: types.Message, state: FSMContext):
 
 # ===== Вайбы =====
 @dp.message(Command("vibes"))
-@dp.message(lambda m: m.text in {tr("ru","btn_set_vibe"), tr("en","btn_set_vibe")})
+@dp.message(Button("btn_set_vibe"))
 async def choose_vibe(message: types.Message):
     user = await get_user(message.from_user.id)
     l = user_lang_from_row(user)
@@ -692,7 +604,7 @@ async def reset_vibe(callback: types.CallbackQuery):
 
 # ===== Интересы =====
 @dp.message(Command("topics"))
-@dp.message(lambda m: m.text in {tr("ru","btn_set_interests"), tr("en","btn_set_interests")})
+@dp.message(Button("btn_set_interests"))
 async def set_interests(message: types.Message):
     user = await get_user(message.from_user.id)
     l = user_lang_from_row(user)
@@ -748,7 +660,7 @@ PREMIUM_PRICES = {
 }
 
 @dp.message(Command("vip"))
-@dp.message(lambda m: m.text in {tr("ru","btn_premium"), tr("en","btn_premium")})
+@dp.message(Button("btn_premium"))
 async def show_vip(message: types.Message):
     user = await get_user(message.from_user.id)
     l = user_lang_from_row(user)
@@ -791,63 +703,21 @@ async def payment_success(message: types.Message):
     if payload.startswith("premium_"):
         months = int(payload.split("_")[-1])
         await set_premium_expiry(message.from_user.id, months)
+        await entitlements.refresh(message.from_user.id)
         await safe_answer(message, tr(l, "premium_activated").format(months=months), reply_markup=kb_main(l))
 
 
 # ===================== ПОИСК / ПОДБОР =====================
-def _cancel_search_task(uid: int):
-    task = search_tasks.pop(uid, None)
-    if task and not task.done():
-        task.cancel()
-
-
-async def find_partner(user_id: int, gender_filter: str | None):
-    user = await get_user(user_id)
-    if not user:
-        return None
-    candidates = await get_waiting_users(
-        language=user[2] or "ru",
-        age=user[1] or 18,
-        gender=gender_filter,
-        vibe=(user[8] or None),
-        age_range=2,
-        min_rating=0,
-        require_adult_access=False
-    )
-    pool_ids = [row[0] for row in candidates if row[0] != user_id and row[0] in searching_users and row[0] not in active_chats]
-    if not pool_ids:
-        pool_ids = [uid for uid in (searching_users - {user_id}) if uid not in active_chats]
-    return random.choice(pool_ids) if pool_ids else None
-
-
-async def _search_loop(uid: int, gender_filter: str | None):
-    deadline = asyncio.get_event_loop().time() + 60.0
-    try:
-        while asyncio.get_event_loop().time() < deadline:
-            if uid not in searching_users or uid in active_chats:
-                return
-            partner_id = await find_partner(uid, gender_filter)
-            if partner_id:
-                await on_chat_started(uid, partner_id)
-                return
-            await asyncio.sleep(3.0)
-    except asyncio.CancelledError:
-        pass
-    except Exception:
-        logging.exception("Ошибка в _search_loop")
-
-
 @dp.message(Command("search"))
-@dp.message(lambda m: m.text in {tr("ru","btn_random"), tr("en","btn_random")})
+@dp.message(Button("btn_random"))
 async def start_search_random(message: types.Message):
     await _start_search_flow(message, gender_filter=None)
 
 
-@dp.message(lambda m: m.text in {tr("ru","btn_find_boy"), tr("en","btn_find_boy"), tr("ru","btn_find_girl"), tr("en","btn_find_girl")})
-async def start_search_gendered(message: types.Message):
-    txt = message.text
-    gender = "male" if txt in {tr("ru","btn_find_boy"), tr("en","btn_find_boy")} else "female"
-    if not await is_premium_active(message.from_user.id) and message.from_user.id not in PERMANENT_PREMIUM_USERS:
+@dp.message(Button("btn_find_boy", "btn_find_girl"))
+async def start_search_gendered(message: types.Message, button: str | None = None):
+    gender = "male" if button == "btn_find_boy" else "female"
+    if not await entitlements.is_active(message.from_user.id):
         user = await get_user(message.from_user.id)
         l = user_lang_from_row(user)
         await safe_answer(message, tr(l, "premium_only"), reply_markup=kb_premium_inline(l))
@@ -867,7 +737,8 @@ async def _start_search_flow(message: types.Message, gender_filter: str | None):
         return
 
     searching_users.add(uid)
-    await set_waiting(uid, 1)
+    m_searches.inc()
+    await set_waiting(uid, 1, gender_filter)
 
     vibe_disp, interests_disp = vibe_and_interests_for(user)
     gender_line = "" if gender_filter is None else tr(l, "pref_gender").format(
@@ -882,32 +753,31 @@ async def _start_search_flow(message: types.Message, gender_filter: str | None):
         ),
         reply_markup=kb_main(l, searching=True)
     )
-    search_tasks[uid] = asyncio.create_task(_search_loop(uid, gender_filter))
+    await cluster.enqueue(SearchTicket.from_user_row(uid, user, gender_filter))
 
 
 async def on_chat_started(uid: int, pid: int):
-    _cancel_search_task(uid)
-    _cancel_search_task(pid)
-    searching_users.discard(uid); searching_users.discard(pid)
-    active_chats[uid] = pid; active_chats[pid] = uid
-    await set_waiting(uid, 0); await set_waiting(pid, 0)
+    # подборщик уже убрал обоих из пула; каждую сторону включает шард её владельца
+    m_matches.inc(); m_matches_today.inc(); m_match_rate.mark()
+    await cluster.call(uid, "chat_started", uid, pid)
+    await cluster.call(pid, "chat_started", pid, uid)
 
-    urow = await get_user(uid)
-    prow = await get_user(pid)
-    lu = user_lang_from_row(urow)
-    lp = user_lang_from_row(prow)
 
-    await safe_send_message(uid, tr(lu, "chat_found"), reply_markup=kb_main(lu, in_chat=True))
-    await safe_send_message(pid, tr(lp, "chat_found"), reply_markup=kb_main(lp, in_chat=True))
+@cluster.action("chat_started")
+async def _chat_started(uid: int, pid: int):
+    searching_users.discard(uid)
+    active_chats[uid] = pid
+    await chat_open(uid, pid)
+    await set_waiting(uid, 0)
+    l = user_lang_from_row(await get_user(uid))
+    await safe_send_message(uid, tr(l, "chat_found"), reply_markup=kb_main(l, in_chat=True))
 
 
 @dp.message(Command("stop"))
-@dp.message(lambda m: m.text in {tr("ru","btn_stop_search"), tr("en","btn_stop_search")})
+@dp.message(Button("btn_stop_search"))
 async def stop_search(message: types.Message):
     uid = message.from_user.id
-    task = search_tasks.pop(uid, None)
-    if task and not task.done():
-        task.cancel()
+    cluster.cancel(uid)
     searching_users.discard(uid)
     await set_waiting(uid, 0)
     user = await get_user(uid)
@@ -917,31 +787,28 @@ async def stop_search(message: types.Message):
 
 @dp.message(Command("restart"))
 @dp.message(Command("next"))
-@dp.message(lambda m: m.text in {tr("ru","btn_restart_chat"), tr("en","btn_restart_chat")})
+@dp.message(Button("btn_restart_chat"))
 async def restart_chat(message: types.Message):
     uid = message.from_user.id
     pid = active_chats.pop(uid, None)
     user = await get_user(uid)
     l = user_lang_from_row(user)
     if pid:
-        active_chats.pop(pid, None)
-        prow = await get_user(pid)
-        lp = user_lang_from_row(prow)
-        await safe_send_message(pid, tr(lp, "partner_left"), reply_markup=kb_main(lp))
-        task = search_tasks.pop(pid, None)
-        if task and not task.done():
-            task.cancel()
+        m_chats_ended.inc()
+        await chat_close(uid)
+        await albums.flush_from(uid)
+        await cluster.call(pid, "partner_left", pid, "partner_left")
+        cluster.cancel(pid)
 
     await safe_answer(message, tr(l, "btn_restart_chat"), reply_markup=kb_main(l, searching=True))
     searching_users.add(uid)
+    m_searches.inc()
     await set_waiting(uid, 1)
-    task = search_tasks.pop(uid, None)
-    if task and not task.done():
-        task.cancel()
-    search_tasks[uid] = asyncio.create_task(_search_loop(uid, gender_filter=None))
+    if user:
+        await cluster.enqueue(SearchTicket.from_user_row(uid, user))
 
 
-@dp.message(lambda m: m.text in {tr("ru","btn_end_chat"), tr("en","btn_end_chat")})
+@dp.message(Button("btn_end_chat"))
 async def end_chat(message: types.Message):
     uid = message.from_user.id
     user = await get_user(uid)
@@ -951,10 +818,10 @@ async def end_chat(message: types.Message):
     if not pid:
         await safe_answer(message, tr(l, "no_active_chat"), reply_markup=kb_main(l))
         return
-    active_chats.pop(pid, None)
-    prow = await get_user(pid)
-    lp = user_lang_from_row(prow)
-    await safe_send_message(pid, tr(lp, "partner_left"), reply_markup=kb_main(lp))
+    m_chats_ended.inc()
+    await chat_close(uid)
+    await albums.flush_from(uid)
+    await cluster.call(pid, "partner_left", pid, "partner_left")
     await safe_answer(message, tr(l, "chat_ended"), reply_markup=kb_main(l))
 
 
@@ -974,8 +841,10 @@ def rating_keyboard(target_id: int, lang: str):
 async def rate_up(callback: types.CallbackQuery):
     rater = callback.from_user.id
     target = int(callback.data.split("_")[-1])
-    await add_rating_log(rater, target)
-    await adjust_rating(target, +3)
+    # оценка — событие; повторный клик по той же клавиатуре (тот же message_id) не учитывается
+    if not await record_rating(rater, target, +3, chat_key=callback.message.message_id):
+        await callback.answer("OK")
+        return
     try:
         await callback.message.edit_reply_markup(None)
     except Exception:
@@ -988,8 +857,9 @@ async def rate_up(callback: types.CallbackQuery):
 async def rate_down(callback: types.CallbackQuery):
     rater = callback.from_user.id
     target = int(callback.data.split("_")[-1])
-    await add_rating_log(rater, target)
-    await adjust_rating(target, -5)
+    if not await record_rating(rater, target, -5, chat_key=callback.message.message_id):
+        await callback.answer("OK")
+        return
     try:
         await callback.message.edit_reply_markup(None)
     except Exception:
@@ -1019,8 +889,11 @@ async def process_report(callback: types.CallbackQuery):
     rater = callback.from_user.id
     target = int(target)
     reasons = {"fake": "Fake/Gender mismatch", "spam": "Spam/Ads", "scam": "Scam/Fraud"}
-    await add_report(target, rater, reasons.get(reason, "Other"), penalty=15)
-    await adjust_rating(target, -15)
+    # штраф -15 входит в событие жалобы (раньше ещё и adjust_rating — списывалось дважды)
+    if not await add_report(target, rater, reasons.get(reason, "Other"), penalty=15,
+                            chat_key=callback.message.message_id):
+        await callback.answer("OK")
+        return
     try:
         await callback.message.edit_reply_markup(None)
     except Exception:
@@ -1030,6 +903,56 @@ async def process_report(callback: types.CallbackQuery):
     await callback.answer("OK")
 
 
+# ===================== ВОССТАНОВЛЕНИЕ ПОСЛЕ РЕСТАРТА =====================
+@dp.startup()
+async def restore_sessions():
+    # диалоги и поиски этого шарда — одной выборкой; сообщения собеседнику снова доходят
+    t0 = time.perf_counter()
+    shard = max(cluster.shard, 0)
+    state = await load_sessions(shard, cluster.shards)
+    active_chats.update(state["active"])
+    searching_users.update(uid for uid, _, _ in state["searching"])
+    # подбор и уведомления идут через лимиты отправки — не держим ими старт
+    asyncio.create_task(_resume_sessions(state["searching"], state["orphaned"]))
+    logging.info(
+        "shard %s: restored %s chats, %s searches, %s orphaned in %.0f ms",
+        shard, len(state["active"]), len(state["searching"]), len(state["orphaned"]),
+        (time.perf_counter() - t0) * 1000,
+    )
+
+
+async def _resume_sessions(searching: list, orphaned: list[int]):
+    for uid, row, gender_filter in searching:
+        if uid in searching_users:  # мог уже остановить поиск
+            await cluster.enqueue(SearchTicket.from_user_row(uid, row, gender_filter))
+    for uid in orphaned:
+        l = user_lang_from_row(await get_user(uid))
+        await safe_send_message(uid, tr(l, "chat_partner_left"), reply_markup=kb_main(l))
+
+
+@dp.shutdown()
+async def flush_fsm():
+    await fsm_storage.close()
+
+
+# ===================== ПРИМЕНЕНИЕ РЕЙТИНГА =====================
+async def start_rating_loop():
+    # один применяющий на весь бот: горячая строка цели обновляется раз за пачку, а не на каждый клик
+    last_compact = time.monotonic()
+    while True:
+        try:
+            while (applied := await apply_rating_events()):
+                m_rating_events.inc(applied)
+            if time.monotonic() - last_compact > RATING_COMPACT_INTERVAL:
+                last_compact = time.monotonic()
+                removed = await compact_rating_log()
+                if removed:
+                    logging.info("rating_log: compacted %s events", removed)
+        except Exception:
+            logging.exception("rating apply error")
+        await asyncio.sleep(RATING_APPLY_INTERVAL)
+
+
 # ===================== РЕАБИЛИТАЦИЯ =====================
 async def start_rehabilitation_loop():
     while True:
@@ -1065,42 +988,70 @@ async def _errors_handler(event: ErrorEvent):
 
 
 # ===================== УНИВЕРСАЛЬНЫЙ РЕЛЕЙ =====================
+# copy_message пересылает любой тип сообщения как есть (форматирование, подписи, опросы, кубики,
+# контакты, анимации) без скачивания файлов; альбом уходит одним copy_messages.
+async def _relay_send(uid: int, pid: int, call, count: int = 1) -> None:
+    try:
+        # через планировщик: порядок сообщений в чате сохраняется, flood wait переотправляется
+        await sender.send(pid, call, priority=RELAY)
+        m_relayed.inc(count); m_relay_rate.mark(count)
+    except TelegramForbiddenError:
+        await _cleanup_blocked_user(pid)
+    except TelegramBadRequest:
+        # то, что скопировать нельзя (служебные сообщения, инвойсы и т.п.)
+        text = tr(user_lang_from_row(await get_user(pid)), "unsupported")
+        await safe_send_message(pid, text)
+    except Exception:
+        logging.exception(f"relay failed {uid} -> {pid}")
+
+
+# доставку собеседнику делает шард, владеющий pid: его планировщик держит очередь этого чата.
+# Пока вызов шёл, pid мог выйти из чата или уже общаться с другим — тогда не доставляем.
+@cluster.action("relay")
+async def _relay(pid: int, uid: int, from_chat: int, message_id: int) -> None:
+    if active_chats.get(pid) != uid:
+        return
+    await _relay_send(uid, pid, lambda: bot.copy_message(pid, from_chat, message_id))
+
+
+@cluster.action("relay_album")
+async def _relay_album(pid: int, uid: int, message_ids: list[int]) -> None:
+    if active_chats.get(pid) != uid:
+        return
+    await _relay_send(uid, pid, lambda: bot.copy_messages(pid, uid, message_ids), len(message_ids))
+
+
+async def _flush_album(pid: int, uid: int, message_ids: list[int]) -> None:
+    await cluster.call(pid, "relay_album", pid, uid, message_ids)
+
+
+albums = MediaGroupBuffer(_flush_album)
+
+
 @dp.message()
 async def relay_any(message: types.Message):
     uid = message.from_user.id
     pid = active_chats.get(uid)
     if not pid:
         return
-    try:
-        if message.text is not None:
-            await bot.send_message(pid, message.text); return
-        if message.photo:
-            await bot.send_photo(pid, message.photo[-1].file_id, caption=message.caption or ""); return
-        if message.sticker:
-            await bot.send_sticker(pid, message.sticker.file_id); return
-        if message.voice:
-            await bot.send_voice(pid, message.voice.file_id, caption=message.caption or ""); return
-        if message.audio:
-            await bot.send_audio(pid, message.audio.file_id, caption=message.caption or ""); return
-        if message.document:
-            await bot.send_document(pid, message.document.file_id, caption=message.caption or ""); return
-        if message.video:
-            await bot.send_video(pid, message.video.file_id, caption=message.caption or ""); return
-        if message.video_note:
-            await bot.send_video_note(pid, message.video_note.file_id); return
-        if message.location:
-            await bot.send_location(pid, message.location.latitude, message.location.longitude); return
-        await bot.send_message(pid, tr(user_lang_from_row(await get_user(pid)), "unsupported"))
-    except TelegramForbiddenError:
-        await _cleanup_blocked_user(pid)
-    except Exception:
-        logging.exception(f"relay failed {uid} -> {pid}")
+    if message.media_group_id:
+        albums.add(message.media_group_id, pid, message.chat.id, message.message_id)
+        return
+    await albums.flush_from(message.chat.id)  # альбом, отправленный перед этим, должен прийти первым
+    await cluster.call(pid, "relay", pid, uid, message.chat.id, message.message_id)
 
 
 # ===================== MAIN =====================
 async def main():
     await init_db()
 
+    if cluster.role == "worker":
+        # воркер шарда: апдейты приходят от координатора, лимит Telegram делится на всех
+        sender.set_global_rate(GLOBAL_RATE / cluster.shards, max(1.0, GLOBAL_BURST / cluster.shards))
+        sender.start()
+        await cluster.run_worker(dp, bot)
+        return
+
     if _ensure_bot_commands:
         try:
             await _ensure_bot_commands(bot)
@@ -1114,17 +1065,27 @@ async def main():
         asyncio.create_task(start_stats_server(host=host, port=port, open_browser=True))
 
     asyncio.create_task(start_rehabilitation_loop())
+    asyncio.create_task(start_rating_loop())
+    asyncio.create_task(matchmaker.run())
+    if cluster.role == "coordinator":
+        logging.info("💫 Neverland запущен: %s шардов.", cluster.shards)
+        await cluster.run_coordinator(dp, bot, script=os.path.abspath(__file__), mode=BOT_MODE)
+        return
+    sender.start()
     logging.info("💫 Neverland запущен.")
-    await dp.start_polling(bot)
+    if BOT_MODE == "webhook":
+        await run_webhook(dp, bot)
+    else:
+        await dp.start_polling(bot)
 
 
 if __name__ == "__main__":
     # --- Windows event loop policy fix (prevents WinError 64 on asyncio sockets) ---
-import sys, asyncio  # injected by patch
-if sys.platform.startswith('win'):
-    try:
-        asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
-    except Exception:
-        pass
-# ------------------------------------------------------------------------------
-asyncio.run(main())
+    import sys
+    if sys.platform.startswith('win'):
+        try:
+            asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
+        except Exception:
+            pass
+    # ------------------------------------------------------------------------------
+    asyncio.run(main())
@@ -2,7 +2,7 @@
 from typing import Optional, Dict, Any
 from .match_engine import enqueue_for_search, cancel_search, try_match, end_chat
 from .database import init_db
-from .database import _backend  # internal access for partner lookup
+from . import database as _db  # internal access for partner lookup (_backend is set by init_db)
 
 # Legacy-compatible names (no-op placeholders when not used by UI)
 async def match_user(user_id: int, profile: Dict[str, Any]) -> Optional[int]:
@@ -16,14 +16,13 @@ async def get_partner_id(user_id: int) -> Optional[int]:
     """Return active partner if there is an ongoing pair (ended_at is NULL)."""
     # direct DB lookup on 'pairs' table
     # This relies on database implementation to expose a connection via _backend
-    be = _backend
+    be = _db._backend
     if be is None:
         return None
     try:
         # SQLite path
         if be.__class__.__name__ == "_SQLite":
-            import aiosqlite
-            async with aiosqlite.connect(be.path) as db:
+            async with be.pool.read(fresh=True) as db:  # пары пишутся через defer()
                 cur = await db.execute("""
                   SELECT CASE WHEN user_a = ? THEN user_b ELSE user_a END AS partner
                     FROM pairs
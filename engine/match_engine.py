@@ -7,7 +7,8 @@ Functions expected by handlers/UI-layer:
   - try_match(user_id, profile_dict) -> partner_id | None
   - end_chat(user_id, partner_id)
 Notes:
-  * If USE_POSTGRES=1 → atomic queue match with SKIP LOCKED.
+  * If USE_POSTGRES=1 → atomic queue match with SKIP LOCKED: the caller's row and its
+    best compatible partner are locked and dequeued together (dequeue_pair_for).
   * Else → fallback via users.waiting + best-effort filtering.
 """
 
@@ -16,9 +17,10 @@ from typing import Optional, Dict, Any
 from .database import (
     init_db,
     set_waiting, get_waiting_users,
-    enqueue_user, dequeue_user, dequeue_two_atomic,
+    enqueue_user, dequeue_user, dequeue_pair_for,
     add_recent_pair, was_recent_pair,
     record_pair_start, record_pair_end,
+    flush_writes,
 )
 
 USE_POSTGRES = int(os.getenv("USE_POSTGRES","0"))
@@ -42,14 +44,13 @@ async def cancel_search(user_id:int) -> None:
 async def try_match(user_id:int, profile:Dict[str,Any]) -> Optional[int]:
     """Return partner_id when matched (and perform bookkeeping), else None."""
     if USE_POSTGRES:
-        pair = await dequeue_two_atomic(exclude_recent_of=user_id, within_secs=1800)
+        pair = await dequeue_pair_for(user_id, within_secs=1800, age_range=profile.get("age_range",2))
         if pair is None:
             return None
         a,b = pair
-        partner = b if a == user_id else a
         await add_recent_pair(a,b)
         await record_pair_start(a,b)
-        return partner if user_id in (a,b) else None
+        return b
     else:
         candidates = await get_waiting_users(language=profile["language"], age=profile["age"],
                                             gender=profile.get("gender"), vibe=profile.get("vibe"),
@@ -65,6 +66,7 @@ async def try_match(user_id:int, profile:Dict[str,Any]) -> Optional[int]:
         await set_waiting(partner_id, 0)
         await add_recent_pair(user_id, partner_id)
         await record_pair_start(user_id, partner_id)
+        await flush_writes()  # пара закоммичена до того, как о ней узнает вызывающий
         return partner_id
 
 async def end_chat(user_id:int, partner_id:int) -> None:
@@ -0,0 +1,75 @@
+# entitlements.py — premium status in memory: one DB lookup per user, flips exactly at premium_until
+import os
+import time
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Optional
+
+from database import PERMANENT_PREMIUM_USERS, get_premium_state  # type: ignore
+from ttl_cache import TTLCache  # type: ignore
+
+RECHECK_AFTER = 600.0  # сек.: перечитываем из БД на случай правок мимо бота (ручной SQL, другой процесс)
+ENTITLEMENTS_CACHE_MAX = int(os.getenv("ENTITLEMENTS_CACHE_MAX", "50000"))
+
+
+@dataclass(slots=True, frozen=True)
+class Entitlement:
+    forever: bool
+    premium_until: Optional[int]  # unix ts
+    loaded_at: float
+
+    def active(self, now: Optional[float] = None) -> bool:
+        if self.forever:
+            return True
+        return self.premium_until is not None and (now or time.time()) < self.premium_until
+
+
+class Entitlements:
+    """
+    Premium state per user, loaded once and kept in memory for `recheck_after`
+    seconds, at most `max_size` users (TTLCache, same as the profile cache).
+
+    Expiry needs no invalidation: active() compares premium_until with the clock,
+    so status flips at the exact second. refresh() re-reads the row and must be
+    called after anything that changes premium (payment_success).
+    """
+
+    def __init__(
+        self,
+        loader: Callable[[int], Awaitable[tuple[bool, Optional[int]]]] = get_premium_state,
+        *,
+        recheck_after: float = RECHECK_AFTER,
+        max_size: int = ENTITLEMENTS_CACHE_MAX,
+    ):
+        self._loader = loader
+        self._cache: TTLCache[Entitlement] = TTLCache(recheck_after, max_size)
+
+    async def _load(self, user_id: int) -> Entitlement:
+        epoch = self._cache.epoch
+        forever, until = await self._loader(user_id)
+        ent = Entitlement(forever or user_id in PERMANENT_PREMIUM_USERS, until, time.monotonic())
+        self._cache.put(user_id, ent, epoch)
+        return ent
+
+    async def refresh(self, user_id: int) -> Entitlement:
+        self._cache.invalidate(user_id)  # чтение, начатое до оплаты, в кэш уже не попадёт
+        return await self._load(user_id)
+
+    async def get(self, user_id: int) -> Entitlement:
+        ent = self._cache.get(user_id)
+        if ent is None:
+            ent = await self._load(user_id)
+        return ent
+
+    async def is_active(self, user_id: int) -> bool:
+        if user_id in PERMANENT_PREMIUM_USERS:
+            return True
+        return (await self.get(user_id)).active()
+
+    def forget(self, user_id: int) -> None:
+        self._cache.invalidate(user_id)
+
+    def stats(self) -> dict:
+        return self._cache.stats()
+
+
+entitlements = Entitlements()
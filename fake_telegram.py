@@ -0,0 +1,167 @@
+# fake_telegram.py — локальная подмена Telegram: Bot API-заглушка + «доставщик» апдейтов на вебхук
+# Usage (benchmark): python fake_telegram.py [N] [concurrency]
+# Бот можно направить на заглушку: TELEGRAM_API=http://127.0.0.1:8081 python bot_2.py
+import asyncio
+import itertools
+import json
+import sys
+import time
+from collections import Counter, deque
+from typing import Any, Iterable, Optional
+
+import aiohttp
+from aiohttp import web
+
+
+class FakeBotAPI:
+    """
+    Minimal Bot API server: answers /bot<token>/<method> with {"ok": true, ...}.
+    Message-returning methods get a stub Message so aiogram can parse the result.
+    Calls are counted per method in self.calls.
+    With global_rate / chat_rate set, send* calls above that many per second
+    (sliding 1 s window) get a 429 with retry_after, like the real API.
+    """
+
+    MESSAGE_METHODS = {"sendMessage", "sendPhoto", "sendVideo", "sendVoice", "sendAudio", "sendDocument",
+                       "sendSticker", "sendAnimation", "sendVideoNote", "editMessageText"}
+
+    def __init__(self, latency: float = 0.0, *, global_rate: int = 0, chat_rate: int = 0):
+        self.latency = latency
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self._global_window: deque[float] = deque()
+        self._chat_windows: dict[int, deque[float]] = {}
+        self.calls: Counter[str] = Counter()
+        self.flood_waits = 0
+        self._ids = itertools.count(1)
+        self._runner: Optional[web.AppRunner] = None
+
+    def _over_limit(self, window: deque, limit: int, now: float) -> bool:
+        while window and now - window[0] >= 1.0:
+            window.popleft()
+        return bool(limit) and len(window) >= limit
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        data: dict[str, Any] = dict(await request.post()) if request.can_read_body else {}
+        if method.startswith("send") or method.startswith("copyMessage"):
+            now = time.monotonic()
+            chat_window = self._chat_windows.setdefault(int(data.get("chat_id") or 0), deque())
+            if self._over_limit(self._global_window, self.global_rate, now) or self._over_limit(chat_window, self.chat_rate, now):
+                self.flood_waits += 1
+                return web.json_response({"ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1",
+                                          "parameters": {"retry_after": 1}})
+            self._global_window.append(now)
+            chat_window.append(now)
+        self.calls[method] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if method in self.MESSAGE_METHODS:
+            chat_id = int(data.get("chat_id") or 0)
+            result: Any = {
+                "message_id": next(self._ids), "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"}, "text": data.get("text", ""),
+            }
+        elif method == "copyMessage":
+            result = {"message_id": next(self._ids)}
+        elif method == "copyMessages":
+            result = [{"message_id": next(self._ids)} for _ in json.loads(data.get("message_ids") or "[]")]
+        elif method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "fake", "username": "fake_bot"}
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    async def start(self, host: str = "127.0.0.1", port: int = 8081) -> str:
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self._handle)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        return f"http://{host}:{port}"
+
+    async def stop(self) -> None:
+        if self._runner:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+def text_update(update_id: int, user_id: int, text: str) -> dict:
+    user = {"id": user_id, "is_bot": False, "first_name": f"u{user_id}"}
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id, "date": int(time.time()), "text": text,
+            "chat": {"id": user_id, "type": "private"}, "from": user,
+        },
+    }
+
+
+async def deliver(url: str, updates: Iterable[dict], *, secret: str = "", concurrency: int = 50) -> dict:
+    """
+    POST updates to a webhook the way Telegram does (secret header, JSON body).
+    503 answers are retried after a short pause, like Telegram redelivery.
+    Returns status counts and per-request latencies.
+    """
+    headers = {"X-Telegram-Bot-Api-Secret-Token": secret} if secret else {}
+    statuses: Counter[int] = Counter()
+    latencies: list[float] = []
+    sem = asyncio.Semaphore(concurrency)
+
+    async with aiohttp.ClientSession(headers=headers) as session:
+        async def one(update: dict) -> None:
+            async with sem:
+                while True:
+                    t0 = time.perf_counter()
+                    async with session.post(url, json=update) as resp:
+                        latencies.append(time.perf_counter() - t0)
+                        statuses[resp.status] += 1
+                        if resp.status != 503:
+                            return
+                    await asyncio.sleep(0.05)
+
+        await asyncio.gather(*(one(u) for u in updates))
+    return {"statuses": dict(statuses), "latencies": latencies}
+
+
+async def _bench(n: int, concurrency: int) -> None:
+    from aiogram import Bot, Dispatcher
+    from aiogram.client.session.aiohttp import AiohttpSession
+    from aiogram.client.telegram import TelegramAPIServer
+    from aiogram.types import Message
+
+    from webhook import WebhookServer
+
+    api = FakeBotAPI(latency=0.005)
+    base = await api.start()
+    bot = Bot("123456:FAKE", session=AiohttpSession(api=TelegramAPIServer.from_base(base)))
+    dp = Dispatcher()
+    handled = 0
+
+    @dp.message()
+    async def echo(message: Message):
+        nonlocal handled
+        await message.answer(message.text or "")
+        handled += 1
+
+    server = WebhookServer(dp, bot, secret="s3cret", url="", queue_size=256, concurrency=concurrency)
+    await server.start(host="127.0.0.1", port=8082)
+    try:
+        t0 = time.perf_counter()
+        res = await deliver("http://127.0.0.1:8082" + server.path,
+                            (text_update(i, 1000 + i % 100, f"msg {i}") for i in range(n)), secret="s3cret")
+        await server.queue.join()
+        dt = time.perf_counter() - t0
+        lat = sorted(res["latencies"])
+        print(f"{n} updates in {dt:.2f}s -> {n / dt:.0f} upd/s, handled={handled}, statuses={res['statuses']}")
+        print(f"webhook ack p50={lat[len(lat) // 2] * 1000:.2f} ms p99={lat[int(len(lat) * 0.99) - 1] * 1000:.2f} ms")
+        print(f"bot api calls: {dict(api.calls)}")
+    finally:
+        await server.stop()
+        await bot.session.close()
+        await api.stop()
+
+
+if __name__ == "__main__":
+    asyncio.run(_bench(int(sys.argv[1]) if len(sys.argv) > 1 else 2000,
+                       int(sys.argv[2]) if len(sys.argv) > 2 else 32))
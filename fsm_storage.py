@@ -0,0 +1,178 @@
+# fsm_storage.py — FSM-хранилище aiogram в PG: кэш в памяти + пакетная запись, TTL брошенных состояний
+import asyncio
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Mapping, Optional
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, KeyBuilder, StateType, StorageKey
+
+from database import fsm_expire, fsm_load, fsm_save_batch  # type: ignore
+
+log = logging.getLogger("fsm_storage")
+
+FSM_STATE_TTL = float(os.getenv("FSM_STATE_TTL", str(24 * 3600)))  # брошенная регистрация живёт сутки
+FSM_FLUSH_INTERVAL = float(os.getenv("FSM_FLUSH_INTERVAL", "1.0"))
+FSM_FLUSH_BATCH = int(os.getenv("FSM_FLUSH_BATCH", "500"))
+FSM_CACHE_MAX = int(os.getenv("FSM_CACHE_MAX", "50000"))
+EXPIRE_EVERY = 3600.0
+
+
+@dataclass(slots=True)
+class _Record:
+    state: Optional[str] = None
+    data: dict[str, Any] = field(default_factory=dict)
+    touched: float = field(default_factory=time.monotonic)
+
+    def empty(self) -> bool:
+        return self.state is None and not self.data
+
+
+class PGStorage(BaseStorage):
+    """
+    FSM storage backed by the fsm_states table.
+
+    Every key is read from the database at most once: the result (including "no
+    state") is cached, so the per-update get_state() of FSMContextMiddleware is a
+    dict lookup. Writes update the cache right away and mark the key dirty; dirty
+    keys are written in one batch every flush_interval seconds (or once flush_batch
+    keys are pending), empty records as deletes. States untouched for `ttl` read as
+    empty and are deleted from the table. close() flushes what is left.
+    With shards each user's key is only touched by its owner process, so the
+    per-process cache stays authoritative.
+    """
+
+    def __init__(
+        self,
+        *,
+        load: Callable[[str, float], Awaitable[Optional[tuple[Optional[str], str]]]] = fsm_load,
+        save: Callable[[list, list], Awaitable[None]] = fsm_save_batch,
+        expire: Callable[[float], Awaitable[int]] = fsm_expire,
+        ttl: float = FSM_STATE_TTL,
+        flush_interval: float = FSM_FLUSH_INTERVAL,
+        flush_batch: int = FSM_FLUSH_BATCH,
+        cache_max: int = FSM_CACHE_MAX,
+        key_builder: Optional[KeyBuilder] = None,
+    ):
+        self._load = load
+        self._save = save
+        self._expire = expire
+        self.ttl = ttl
+        self._flush_interval = flush_interval
+        self._flush_batch = flush_batch
+        self._cache_max = cache_max
+        self._keys = key_builder or DefaultKeyBuilder(with_destiny=True)
+        self._cache: "OrderedDict[str, _Record]" = OrderedDict()
+        self._dirty: set[str] = set()
+        self._flusher: Optional[asyncio.Task] = None
+        self._last_expire = time.monotonic()
+        self.loads = 0
+        self.flushes = 0
+
+    # ---------- кэш ----------
+    async def _record(self, key: StorageKey) -> tuple[str, _Record]:
+        k = self._keys.build(key)
+        rec = self._cache.get(k)
+        now = time.monotonic()
+        if rec is not None:
+            if now - rec.touched > self.ttl and k not in self._dirty:
+                rec = self._cache[k] = _Record()
+            self._cache.move_to_end(k)
+            return k, rec
+        self.loads += 1
+        row = await self._load(k, self.ttl)
+        loaded = _Record(row[0], json.loads(row[1])) if row else _Record()
+        # пока читали, ключ мог быть записан — запись новее
+        rec = self._cache.setdefault(k, loaded)
+        self._cache.move_to_end(k)
+        self._evict()
+        return k, rec
+
+    def _evict(self) -> None:
+        # выкидываем только записанные в БД записи; грязные дождутся flush
+        excess = len(self._cache) - self._cache_max
+        if excess <= 0:
+            return
+        for k in list(self._cache):
+            if excess <= 0:
+                break
+            if k not in self._dirty:
+                del self._cache[k]
+                excess -= 1
+
+    def _touch(self, k: str, rec: _Record) -> None:
+        rec.touched = time.monotonic()
+        self._dirty.add(k)
+        if len(self._dirty) >= self._flush_batch:
+            self._spawn_flush(0.0)
+        else:
+            self._spawn_flush(self._flush_interval)
+
+    def _spawn_flush(self, delay: float) -> None:
+        if self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.create_task(self._flush_later(delay))
+
+    async def _flush_later(self, delay: float) -> None:
+        if delay:
+            await asyncio.sleep(delay)
+        try:
+            await self.flush()
+        except Exception:
+            log.exception("fsm flush failed, %s keys stay pending", len(self._dirty))
+            await asyncio.sleep(self._flush_interval)
+        if self._dirty:
+            self._flusher = asyncio.create_task(self._flush_later(self._flush_interval))
+
+    async def flush(self) -> None:
+        """Write all dirty keys now (one batch)."""
+        if self._dirty:
+            keys, self._dirty = self._dirty, set()
+            upserts, deletes = [], []
+            for k in keys:
+                rec = self._cache.get(k)
+                if rec is None or rec.empty():
+                    deletes.append(k)
+                else:
+                    upserts.append((k, rec.state, json.dumps(rec.data, ensure_ascii=False)))
+            try:
+                await self._save(upserts, deletes)
+            except BaseException:
+                self._dirty |= keys  # повторим со следующим flush (в т.ч. если прервали в close)
+                raise
+            self.flushes += 1
+        if time.monotonic() - self._last_expire > EXPIRE_EVERY:
+            self._last_expire = time.monotonic()
+            removed = await self._expire(self.ttl)
+            if removed:
+                log.info("fsm: expired %s abandoned states", removed)
+
+    # ---------- BaseStorage ----------
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        k, rec = await self._record(key)
+        rec.state = state.state if isinstance(state, State) else state
+        self._touch(k, rec)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        _, rec = await self._record(key)
+        return rec.state
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        k, rec = await self._record(key)
+        rec.data = dict(data)
+        self._touch(k, rec)
+
+    async def get_data(self, key: StorageKey) -> dict[str, Any]:
+        _, rec = await self._record(key)
+        return dict(rec.data)
+
+    async def close(self) -> None:
+        if self._flusher and not self._flusher.done():
+            self._flusher.cancel()
+        await self.flush()
+
+    def stats(self) -> dict:
+        return {"cached": len(self._cache), "dirty": len(self._dirty), "loads": self.loads, "flushes": self.flushes}
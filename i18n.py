@@ -0,0 +1,273 @@
+# i18n.py — RU/EN строки бота: таблицы собираются один раз при импорте, кнопки ищутся по обратной карте
+from types import MappingProxyType
+from typing import Mapping, Optional
+
+from aiogram.filters import Filter
+from aiogram.types import Message
+
+LANGS = ("ru", "en")
+
+_SOURCE = {
+    "ru": {
+        # Кнопки главного меню
+        "btn_random": "🎯 Случайный собеседник",
+        "btn_find_girl": "👩 Поиск девушки",
+        "btn_find_boy": "👨 Поиск парня",
+        "btn_settings": "⚙ Настройки",
+        "btn_profile": "👁 Профиль",
+        "btn_about": "🌌 О Neverland",
+        "btn_premium": "💎 Premium",
+        # Кнопки состояний
+        "btn_stop_search": "⛔ Остановить поиск",
+        "btn_end_chat": "🚫 Завершить диалог",
+        "btn_restart_chat": "🔄 Завершить и искать нового",
+        "btn_back": "🔙 Назад",
+        # Кнопки настроек
+        "btn_set_age": "✏️ Сменить возраст",
+        "btn_set_gender": "🚻 Сменить пол",
+        "btn_set_lang": "🌐 Сменить язык",
+        "btn_set_vibe": "✨ Сменить вайб",
+        "btn_set_interests": "🎯 Сменить интересы",
+
+        # Регистрация/общие
+        "welcome": "💫 Добро пожаловать в <b>Neverland Chat</b> — давай настроим профиль.",
+        "ask_gender": "Выбери пол:",
+        "gender_male": "Парень",
+        "gender_female": "Девушка",
+        "ask_age": "📅 Введи возраст (13–100):",
+        "err_age": "Возраст должен быть от 13 до 100. Попробуй ещё раз:",
+        "ask_lang": "Выбери язык:",
+        "lang_ru": "Русский",
+        "lang_en": "English",
+
+        # Меню/профиль/правила/о проекте
+        "menu_title": "💬 Главное меню:",
+        "settings_title": "⚙️ Настройки профиля:",
+        "profile_title": "👤 <b>Твой профиль</b>",
+        "rules": (
+            "📜 <b>Правила Neverland Chat</b>\n\n"
+            "1. Уважай анонимность — не раскрывай личные данные.\n"
+            "2. Не отправляй личные фото без согласия.\n"
+            "3. Без оскорблений, спама и рекламы.\n"
+            "4. Контент 18+ запрещён.\n"
+            "5. Нарушения снижают карму и могут привести к бану."
+        ),
+        "about": (
+            "🌌 <b>Neverland Chat</b> — анонимный уют среди звёзд.\n"
+            "Без масок и лишних соцсетей — только живой разговор с незнакомцем на одной волне.\n\n"
+            "<b>Почему здесь классно</b>\n"
+            "• 🎯 Умный подбор по вайбу и интересам\n"
+            "• 💬 Чистый диалог — один приватный чат\n"
+            "• 🌟 Карма и защита от абуза\n"
+            "• ⏳ Честное ожидание\n\n"
+            "💫 <i>Neverland — место, где легко быть собой и находить тёплые диалоги.</i>"
+        ),
+
+        # Профиль
+        "id_line": "🪪 Твой Telegram ID: <code>{id}</code>",
+        "gender_line": "Пол: <b>{gender}</b>",
+        "age_line": "Возраст: <b>{age}</b>",
+        "lang_line": "Язык: <b>{lang}</b>",
+        "vibe_line": "Вайб: <b>{vibe}</b>",
+        "interests_line": "Интересы: <b>{interests}</b>",
+        "rating_line": "Карма: <b>{rating}</b> 🌟",
+        "premium_status": "Статус: {status}",
+        "premium_forever": "💎 Premium (навсегда)",
+        "premium_until": "💎 Premium (до {date})",
+        "premium_free": "🆓 Базовый",
+
+        # Поиск/чат
+        "search_started": "🌠 Начинаем поиск собеседника...\n\n{gender_pref}{vibe}\n{interests}\n\nИщем того, кто на одной волне с тобой 💫",
+        "pref_gender": "Предпочтение по полу: <b>{gender}</b>\n",
+        "chat_found": "🌟 <b>Собеседник найден!</b>\n\n🪄 Команды:\n/stop — завершить диалог\n/restart — завершить и искать нового",
+        "already_searching": "🔍 Уже идёт поиск или ты в чате.",
+        "search_stopped": "🛑 Поиск остановлен.",
+        "no_active_chat": "❗ У тебя нет активного диалога.",
+        "partner_left": "😔 Собеседник покинул чат.",
+        "chat_ended": "💬 Диалог завершён.",
+        "unsupported": "📎 Получен неподдерживаемый тип сообщения.",
+        "chat_partner_left": "😔 Собеседник завершил диалог.",
+
+        # Настройки/сохранение
+        "ask_new_age": "📅 Введи новый возраст (13–100):",
+        "age_saved": "✅ Возраст обновлён: {age}",
+        "gender_saved": "✅ Пол обновлён.",
+        "ask_new_lang": "Выбери язык:",
+        "lang_saved": "✅ Язык обновлён.",
+        "choose_vibe": "💫 Выбери свой вайб:",
+        "choose_interests": "🎯 Выбери интересы (нажатие — сразу сохраняет):",
+        "vibe_reset": "🔄 Вайб сброшен.",
+        "interests_reset": "🔄 Все интересы очищены.",
+        "interest_add": "{key} — добавлено",
+        "interest_remove": "{key} — убрано",
+
+        # Premium
+        "premium_text": (
+            "💎 <b>Neverland Premium</b>\n\n"
+            "✨ Что даёт Premium:\n"
+            "• Поиск по полу (👩 / 👨)\n"
+            "• Без ограничений на количество чатов\n"
+            "• Приоритет в поиске и выдаче\n"
+            "• Маленький значок 💎 в профиле\n\n"
+            "Оплата через Telegram Stars ⭐"
+        ),
+        "premium_only": "💎 <b>Эта функция доступна только Premium-пользователям.</b>",
+        "premium_activated": "💎 Premium активирован на {months} мес!",
+    },
+    "en": {
+        # Buttons
+        "btn_random": "🎯 Random match",
+        "btn_find_girl": "👩 Find a girl",
+        "btn_find_boy": "👨 Find a boy",
+        "btn_settings": "⚙ Settings",
+        "btn_profile": "👁 Profile",
+        "btn_about": "🌌 About Neverland",
+        "btn_premium": "💎 Premium",
+        "btn_stop_search": "⛔ Stop searching",
+        "btn_end_chat": "🚫 End chat",
+        "btn_restart_chat": "🔄 End & find new",
+        "btn_back": "🔙 Back",
+        "btn_set_age": "✏️ Change age",
+        "btn_set_gender": "🚻 Change gender",
+        "btn_set_lang": "🌐 Change language",
+        "btn_set_vibe": "✨ Change vibe",
+        "btn_set_interests": "🎯 Change interests",
+
+        # Registration/general
+        "welcome": "💫 Welcome to <b>Neverland Chat</b> — let’s set up your profile.",
+        "ask_gender": "Choose your gender:",
+        "gender_male": "Boy",
+        "gender_female": "Girl",
+        "ask_age": "📅 Enter age (13–100):",
+        "err_age": "Age must be between 13 and 100. Try again:",
+        "ask_lang": "Choose language:",
+        "lang_ru": "Русский",
+        "lang_en": "English",
+
+        # Menu/profile/rules/about
+        "menu_title": "💬 Main menu:",
+        "settings_title": "⚙️ Profile settings:",
+        "profile_title": "👤 <b>Your profile</b>",
+        "rules": (
+            "📜 <b>Neverland Chat Rules</</b>\n\n"
+            "1. Respect anonymity — no personal data.\n"
+            "2. Don’t send personal photos without consent.\n"
+            "3. No insults, spam or ads.\n"
+            "4. 18+ content is not allowed.\n"
+            "5. Violations reduce karma and may lead to a ban."
+        ),
+        "about": (
+            "🌌 <b>Neverland Chat</b> — anonymous cozy space among stars.\n"
+            "No masks, no socials — just real talk with a like-minded stranger.\n\n"
+            "<b>Why it’s nice</b>\n"
+            "• 🎯 Smart matching via vibe & interests\n"
+            "• 💬 Single clean private dialog\n"
+            "• 🌟 Karma & abuse protection\n"
+            "• ⏳ Fair waiting\n\n"
+            "💫 <i>Neverland — a place to be yourself and find warm conversations.</i>"
+        ),
+
+        # Profile
+        "id_line": "🪪 Your Telegram ID: <code>{id}</code>",
+        "gender_line": "Gender: <b>{gender}</b>",
+        "age_line": "Age: <b>{age}</b>",
+        "lang_line": "Language: <b>{lang}</b>",
+        "vibe_line": "Vibe: <b>{vibe}</b>",
+        "interests_line": "Interests: <b>{interests}</b>",
+        "rating_line": "Karma: <b>{rating}</b> 🌟",
+        "premium_status": "Status: {status}",
+        "premium_forever": "💎 Premium (forever)",
+        "premium_until": "💎 Premium (till {date})",
+        "premium_free": "🆓 Free",
+
+        # Search/chat
+        "search_started": "🌠 Starting the search...\n\n{gender_pref}{vibe}\n{interests}\n\nLooking for someone on your wavelength 💫",
+        "pref_gender": "Gender preference: <b>{gender}</b>\n",
+        "chat_found": "🌟 <b>Match found!</b>\n\n🪄 Commands:\n/stop — end chat\n/restart — end & find new",
+        "already_searching": "🔍 You’re already searching or in a chat.",
+        "search_stopped": "🛑 Search stopped.",
+        "no_active_chat": "❗ You have no active dialog.",
+        "partner_left": "😔 Your partner left the chat.",
+        "chat_ended": "💬 Dialog ended.",
+        "unsupported": "📎 Unsupported message type.",
+        "chat_partner_left": "😔 Your partner ended the dialog.",
+
+        # Settings/saving
+        "ask_new_age": "📅 Enter new age (13–100):",
+        "age_saved": "✅ Age updated: {age}",
+        "gender_saved": "✅ Gender updated.",
+        "ask_new_lang": "Choose language:",
+        "lang_saved": "✅ Language updated.",
+        "choose_vibe": "💫 Choose your vibe:",
+        "choose_interests": "🎯 Choose interests (tap saves instantly):",
+        "vibe_reset": "🔄 Vibe cleared.",
+        "interests_reset": "🔄 Interests cleared.",
+        "interest_add": "{key} — added",
+        "interest_remove": "{key} — removed",
+
+        # Premium
+        "premium_text": (
+            "💎 <b>Neverland Premium</b>\n\n"
+            "✨ What you get:\n"
+            "• Gender search (👩 / 👨)\n"
+            "• No chat count limits\n"
+            "• Priority in queue & matching\n"
+            "• Small 💎 badge in profile\n\n"
+            "Payment via Telegram Stars ⭐"
+        ),
+        "premium_only": "💎 <b>This feature is for Premium users only.</b>",
+        "premium_activated": "💎 Premium activated for {months} mo!",
+    },
+}
+
+
+def _compile(source: dict) -> dict[str, Mapping[str, str]]:
+    # en дополняется ключами из ru — tr() делает один .get() без второго поиска
+    base = source["ru"]
+    return {lang: MappingProxyType({**base, **source[lang]}) for lang in LANGS}
+
+
+TR: Mapping[str, Mapping[str, str]] = MappingProxyType(_compile(_SOURCE))
+_TR_RU, _TR_EN = TR["ru"], TR["en"]
+
+
+def tr(lang: str, key: str) -> str:
+    return (_TR_EN if lang == "en" else _TR_RU).get(key, key)
+
+
+def _button_actions(tables: Mapping[str, Mapping[str, str]]) -> Mapping[str, str]:
+    # текст кнопки (на любом языке) -> ключ кнопки ("btn_back", ...)
+    out: dict[str, str] = {}
+    for table in tables.values():
+        for key, text in table.items():
+            if not key.startswith("btn_"):
+                continue
+            prev = out.setdefault(text, key)
+            if prev != key:
+                raise ValueError(f"button text {text!r} is shared by {prev} and {key}")
+    return MappingProxyType(out)
+
+
+BUTTON_ACTIONS: Mapping[str, str] = _button_actions(TR)
+
+
+def button_action(text: Optional[str]) -> Optional[str]:
+    return BUTTON_ACTIONS.get(text) if text else None
+
+
+class ButtonMiddleware:
+    """Outer message middleware: resolves the pressed button once per update into data["button"]."""
+
+    async def __call__(self, handler, event: Message, data: dict):
+        data["button"] = button_action(event.text)
+        return await handler(event, data)
+
+
+class Button(Filter):
+    """Matches reply-keyboard buttons by key, e.g. Button("btn_back"), using data["button"]."""
+
+    def __init__(self, *keys: str):
+        self.keys = frozenset(keys)
+
+    async def __call__(self, message: Message, button: Optional[str] = None) -> bool:
+        return button in self.keys
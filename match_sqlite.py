@@ -1,9 +1,15 @@
-import time, os
-from typing import Optional, List, Any
+import asyncio, bisect, itertools, logging, time, os, zlib
+from typing import Optional, List, Any, Awaitable, Callable
 import aiosqlite
+try:
+    import numpy as np
+except ImportError:  # numpy в requirements.txt; без него — тот же подбор обычными циклами, медленнее
+    np = None
+    logging.getLogger("match_sqlite").warning("numpy not installed: try_match falls back to pure-Python ranking")
 SQLITE_PATH = os.getenv("SQLITE_PATH", "users.db")
 ANTI_REMATCH = os.getenv("ANTI_REMATCH", "0") == "1"
 ANTI_REMATCH_MINUTES = int(os.getenv("ANTI_REMATCH_MINUTES", "120"))
+BATCH_INTERVAL = float(os.getenv("MATCH_BATCH_INTERVAL", "2"))
 CREATE_SQL = [
     '''
     CREATE TABLE IF NOT EXISTS queue (
@@ -16,7 +22,10 @@ CREATE_SQL = [
         age_min INTEGER,
         age_max INTEGER,
         vibe TEXT,
-        interests TEXT
+        interests TEXT,
+        interests_mask INTEGER DEFAULT 0,
+        vibe_code INTEGER DEFAULT 0,
+        lang_code INTEGER DEFAULT 0
     )''',
     '''
     CREATE TABLE IF NOT EXISTS chats (
@@ -40,11 +49,27 @@ if ANTI_REMATCH:
             user2 INTEGER,
             ts REAL
         )''')
+# колонки с предкодированным профилем; в старых базах queue создана без них
+ENCODED_COLS = ("interests_mask", "vibe_code", "lang_code")
+_schema_ready = False
 async def init_db():
+    global _schema_ready
+    if _schema_ready: return
     async with aiosqlite.connect(SQLITE_PATH) as db:
         for sql in CREATE_SQL:
             await db.execute(sql)
+        async with db.execute("PRAGMA table_info(queue)") as cur:
+            cols = {r[1] for r in await cur.fetchall()}
+        missing = [col for col in ENCODED_COLS if col not in cols]
+        for col in missing:
+            await db.execute(f"ALTER TABLE queue ADD COLUMN {col} INTEGER DEFAULT 0")
+        if missing:  # дозакодировать тех, кто уже стоит в очереди
+            async with db.execute("SELECT user_id, interests, vibe, lang FROM queue") as cur:
+                old = await cur.fetchall()
+            await db.executemany("UPDATE queue SET interests_mask=?, vibe_code=?, lang_code=? WHERE user_id=?",
+                                 [(*encode_profile(dict(interests=i, vibe=v, lang=l)), uid) for uid, i, v, l in old])
         await db.commit()
+    _schema_ready = True
 def _csv_set(raw: Any) -> set[str]:
     if not raw: return set()
     if isinstance(raw, str):
@@ -56,23 +81,70 @@ def _gender_ok(wants: str, partner_gender: Optional[str]) -> bool:
     if wants in (None, "", "any"): return True
     if partner_gender is None: return True
     return wants == partner_gender
-def _score(me: dict, cand: dict) -> float:
-    s_inter = _csv_set(me.get("interests")); c_inter = _csv_set(cand.get("interests"))
-    score = len(s_inter & c_inter)
-    if (me.get("vibe") or "").strip().lower() == (cand.get("vibe") or "").strip().lower() and me.get("vibe"):
-        score += 0.5
-    if (me.get("lang") or "").strip().lower() == (cand.get("lang") or "").strip().lower() and me.get("lang"):
-        score += 0.2
+def age_ok_mutual(cand_age, me_lo, me_hi, me_age, cand_lo, cand_hi):
+    if me_age is not None and not (cand_lo <= me_age <= cand_hi): return False
+    if cand_age is not None and not (me_lo <= cand_age <= me_hi): return False
+    return True
+# --- profile encoding: interests -> bitmask, vibe/lang -> small ints (done once, on add_to_queue) ---
+# словарь = нормализованные ключи bot_2.INTERESTS_MAP (ru, затем en); у каждого свой бит
+INTEREST_VOCAB = [
+    "флирт", "мемы", "музыка", "фильмы", "книги", "одиночество", "технологии", "путешествия",
+    "flirt", "memes", "music", "movies", "books", "loneliness", "tech", "travel",
+]
+VIBE_VOCAB = ["funny", "calm", "romantic", "philosophic", "dark", "chill"]
+LANG_VOCAB = ["ru", "en"]
+_INTEREST_BITS = {k: i for i, k in enumerate(INTEREST_VOCAB)}
+_HASH_BITS = 63 - len(INTEREST_VOCAB)  # SQLite INTEGER знаковый — старший бит не трогаем
+def _interest_bit(item: str) -> int:
+    bit = _INTEREST_BITS.get(item)
+    if bit is None:  # свободный текст: стабильный хэш в оставшиеся биты (возможны редкие коллизии)
+        bit = len(INTEREST_VOCAB) + zlib.crc32(item.encode()) % _HASH_BITS
+    return bit
+def interests_mask(raw: Any) -> int:
+    mask = 0
+    for item in _csv_set(raw):
+        mask |= 1 << _interest_bit(item)
+    return mask
+def _code(vocab: List[str], raw: Optional[str]) -> int:
+    v = (raw or "").strip().lower()
+    if not v: return 0
+    if v in vocab: return vocab.index(v) + 1
+    return (zlib.crc32(v.encode()) & 0x3FFFFFFF) + len(vocab) + 1
+def encode_profile(p: dict) -> tuple[int, int, int]:
+    return interests_mask(p.get("interests")), _code(VIBE_VOCAB, p.get("vibe")), _code(LANG_VOCAB, p.get("lang"))
+def _score_codes(me: tuple[int, int, int], cand: tuple[int, int, int]) -> float:
+    score = (me[0] & cand[0]).bit_count()
+    if me[1] and me[1] == cand[1]: score += 0.5
+    if me[2] and me[2] == cand[2]: score += 0.2
     return score
+def _score(me: dict, cand: dict) -> float:
+    return _score_codes(encode_profile(me), encode_profile(cand))
+_POP8 = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8) if np is not None else None
+def _popcount64(arr):
+    if hasattr(np, "bitwise_count"):  # numpy >= 2.0
+        return np.bitwise_count(arr)
+    return _POP8[np.ascontiguousarray(arr).view(np.uint8)].reshape(-1, 8).sum(axis=1)
+def rank_scores(me: tuple[int, int, int], codes: List[tuple[int, int, int]]):
+    """Scores of `me` against every encoded candidate, in the same order as `codes`.
+    `codes` may already be an (n, 3) int64 array — then nothing is converted per call."""
+    if np is None or len(codes) == 0:
+        return [_score_codes(me, c) for c in codes]
+    arr = codes if isinstance(codes, np.ndarray) else np.array(codes, dtype=np.int64)
+    scores = _popcount64(arr[:, 0] & me[0]).astype(np.float64)
+    if me[1]: scores += 0.5 * (arr[:, 1] == me[1])
+    if me[2]: scores += 0.2 * (arr[:, 2] == me[2])
+    return scores
 async def add_to_queue(user_id: int, lang: str, age: int, gender: Optional[str],
                        wants_gender: str, age_min: int, age_max: int,
                        vibe: Optional[str], interests: List[str]):
     await init_db()
     interests_csv = ",".join(x.strip().lower() for x in (interests or []))
+    codes = encode_profile(dict(interests=interests_csv, vibe=vibe, lang=lang))
     async with aiosqlite.connect(SQLITE_PATH) as db:
         await db.execute(
-            "REPLACE INTO queue(user_id, ts, lang, age, gender, wants_gender, age_min, age_max, vibe, interests) VALUES(?,?,?,?,?,?,?,?,?,?)",
-            (user_id, time.time(), lang, age, gender, wants_gender, age_min, age_max, vibe, interests_csv)
+            "REPLACE INTO queue(user_id, ts, lang, age, gender, wants_gender, age_min, age_max, vibe, interests,"
+            " interests_mask, vibe_code, lang_code) VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?)",
+            (user_id, time.time(), lang, age, gender, wants_gender, age_min, age_max, vibe, interests_csv, *codes)
         )
         await db.commit()
 async def remove_from_queue(user_id: int):
@@ -106,47 +178,159 @@ async def end_chat(my_id: int) -> Optional[int]:
         await db.execute("DELETE FROM chats WHERE pair_id=?", (pair_id,))
         await db.commit()
         return u2 if u1 == my_id else u1
-async def _recent_rows(user_id: int):
-    if not ANTI_REMATCH: return []
+# запрос try_match: всё числами, чтобы очередь целиком легла в один (n, 9) int64 массив;
+# NULL-возраст/границы и пол кодируются прямо в SQL (пол: 0 — не указан, 1 — тот, кого ищу, 2 — другой)
+_AGE_LO, _AGE_HI = -(1 << 31), 1 << 31
+TRY_MATCH_SQL = f"""
+SELECT user_id, age IS NOT NULL, COALESCE(age, 0), COALESCE(age_min, {_AGE_LO}), COALESCE(age_max, {_AGE_HI}),
+       CASE WHEN gender IS NULL THEN 0 WHEN gender = ? THEN 1 ELSE 2 END,
+       COALESCE(interests_mask, 0), COALESCE(vibe_code, 0), COALESCE(lang_code, 0)
+  FROM queue WHERE user_id != ? ORDER BY ts ASC
+"""
+def _filter_pool(me: dict, me_codes: tuple[int, int, int], rows: list, blocked: set):
+    """(candidate ids, their codes) that pass the same checks as age_ok_mutual/_gender_ok, queue order kept."""
+    me_age = me.get("age")
+    me_lo = me.get("age_min") if me.get("age_min") is not None else _AGE_LO
+    me_hi = me.get("age_max") if me.get("age_max") is not None else _AGE_HI
+    any_gender = me.get("wants_gender", "any") in (None, "", "any")
+    lang = me_codes[2]
+    if np is None:
+        keep = [r for r in rows
+                if (me_age is None or r[3] <= me_age <= r[4])
+                and (not r[1] or me_lo <= r[2] <= me_hi)
+                and (any_gender or r[5] != 2)
+                and (not lang or not r[8] or r[8] == lang)
+                and r[0] not in blocked]
+        return [r[0] for r in keep], [r[6:9] for r in keep]
+    # fromiter по плоскому потоку заметно быстрее np.array(list of tuples)
+    arr = np.fromiter(itertools.chain.from_iterable(rows), dtype=np.int64, count=len(rows) * 9).reshape(-1, 9)
+    ok = np.ones(len(arr), dtype=bool)
+    if me_age is not None:
+        ok &= (arr[:, 3] <= me_age) & (me_age <= arr[:, 4])
+    ok &= (arr[:, 1] == 0) | ((me_lo <= arr[:, 2]) & (arr[:, 2] <= me_hi))
+    if not any_gender:
+        ok &= arr[:, 5] != 2
+    if lang:
+        ok &= (arr[:, 8] == 0) | (arr[:, 8] == lang)
+    if blocked:
+        ok &= ~np.isin(arr[:, 0], list(blocked))
+    return arr[ok, 0], arr[ok, 6:9]
+async def _recent_partners(user_id: int, now_ts: float) -> set:
+    # recent_pairs пишется в обе стороны — достаточно user1
+    if not ANTI_REMATCH: return set()
     async with aiosqlite.connect(SQLITE_PATH) as db:
-        async with db.execute("SELECT user2, ts FROM recent_pairs WHERE user1=?", (user_id,)) as cur:
-            return await cur.fetchall()
-def _recent_blocked(rows, cand_id: int, now_ts: float) -> bool:
-    win = ANTI_REMATCH_MINUTES * 60
-    for u2, ts in rows:
-        if u2 == cand_id and (now_ts - ts) < win:
-            return True
-    return False
+        async with db.execute("SELECT user2 FROM recent_pairs WHERE user1=? AND ts > ?",
+                              (user_id, now_ts - ANTI_REMATCH_MINUTES * 60)) as cur:
+            return {r[0] for r in await cur.fetchall()}
 async def try_match(new_user_id: int, profile_cb):
     await init_db()
     me = await profile_cb(new_user_id)
     if not me: return None
-    now = time.time()
-    rp_me = await _recent_rows(new_user_id)
+    blocked = await _recent_partners(new_user_id, time.time())
+    wants = me.get("wants_gender", "any")
+    async with aiosqlite.connect(SQLITE_PATH) as db:
+        async with db.execute(TRY_MATCH_SQL, (wants, new_user_id)) as cur:
+            rows = await cur.fetchall()
+    if not rows: return None
+    me_codes = encode_profile(me)
+    ids, codes = _filter_pool(me, me_codes, rows, blocked)
+    if len(ids) == 0: return None
+    scores = rank_scores(me_codes, codes)
+    # первый из равных — при равном счёте выигрывает самый старый в очереди
+    best = int(ids[int(np.argmax(scores)) if np is not None else max(range(len(ids)), key=scores.__getitem__)])
+    await set_chat(new_user_id, best)
+    return best
+# --- batch mode: one snapshot of the queue -> one global pairing -> one transaction ---
+QUEUE_COLS = "user_id, ts, lang, age, gender, wants_gender, age_min, age_max, vibe, interests, interests_mask, vibe_code, lang_code"
+def _pair_ok(a: dict, b: dict) -> bool:
+    if not age_ok_mutual(b["age"], a["age_min"], a["age_max"], a["age"], b["age_min"], b["age_max"]): return False
+    if a["lang"] and b["lang"] and a["lang"] != b["lang"]: return False
+    return _gender_ok(a["wants_gender"], b["gender"]) and _gender_ok(b["wants_gender"], a["gender"])
+def _candidate_edges(group: list[dict], recent: set) -> list[tuple[float, float, int, int]]:
+    # group отсортирована по возрасту: кандидатов для a берём бинпоиском по его окну age_min..age_max,
+    # вместо полного перебора n² (взаимность возраста всё равно проверяет _pair_ok)
+    ages = [c["age"] for c in group]
+    edges = []
+    for i, a in enumerate(group):
+        lo = bisect.bisect_left(ages, a["age_min"]) if a["age_min"] is not None else 0
+        hi = bisect.bisect_right(ages, a["age_max"]) if a["age_max"] is not None else len(group)
+        for j in range(max(lo, i + 1), hi):
+            b = group[j]
+            if (a["user_id"], b["user_id"]) in recent or not _pair_ok(a, b): continue
+            edges.append((_score_codes(a["codes"], b["codes"]), max(a["ts"], b["ts"]), a["user_id"], b["user_id"]))
+    return edges
+def plan_pairs(rows: List[dict], recent: Optional[set] = None) -> list[tuple[int, int]]:
+    """Greedy maximum-score matching over a queue snapshot.
+    Edges are taken by score desc, then by how long the younger entry of the pair has waited;
+    users without an age (or language) can't be bisected and go through the plain scan."""
+    recent = recent or set()
+    groups: dict[str, list[dict]] = {}
+    loose: list[dict] = []
+    for r in rows:
+        if r["age"] is None or not r["lang"]: loose.append(r)
+        else: groups.setdefault(r["lang"], []).append(r)
+    edges = []
+    for group in groups.values():
+        group.sort(key=lambda c: c["age"])
+        edges += _candidate_edges(group, recent)
+    grouped = [r for group in groups.values() for r in group]
+    for k, a in enumerate(loose):
+        for b in loose[k + 1:] + grouped:
+            if (a["user_id"], b["user_id"]) in recent or not _pair_ok(a, b): continue
+            edges.append((_score_codes(a["codes"], b["codes"]), max(a["ts"], b["ts"]), a["user_id"], b["user_id"]))
+    edges.sort(key=lambda e: (-e[0], e[1]))
+    taken: set[int] = set()
+    pairs = []
+    for _, _, a, b in edges:
+        if a in taken or b in taken: continue
+        taken.update((a, b))
+        pairs.append((a, b))
+    return pairs
+async def _recent_set(now_ts: float) -> set:
+    if not ANTI_REMATCH: return set()
     async with aiosqlite.connect(SQLITE_PATH) as db:
-        async with db.execute("SELECT user_id, lang, age, gender, wants_gender, age_min, age_max, vibe, interests FROM queue WHERE user_id!=? ORDER BY ts ASC", (new_user_id,)) as cur:
+        async with db.execute("SELECT user1, user2 FROM recent_pairs WHERE ts > ?", (now_ts - ANTI_REMATCH_MINUTES * 60,)) as cur:
             rows = await cur.fetchall()
-    def age_ok_mutual(cand_age, me_lo, me_hi, me_age, cand_lo, cand_hi):
-        if me_age is not None and not (cand_lo <= me_age <= cand_hi): return False
-        if cand_age is not None and not (me_lo <= cand_age <= me_hi): return False
-        return True
-    pool = []
-    for (uid, lang, age, gender, wants_gender, lo, hi, vibe, interests_csv) in rows:
-        cand = dict(user_id=uid, lang=lang, age=age, gender=gender, wants_gender=wants_gender,
-                    age_min=lo, age_max=hi, vibe=vibe, interests=interests_csv)
-        if not age_ok_mutual(age, me.get("age_min"), me.get("age_max"), me.get("age"), lo, hi): continue
-        if me.get("lang") and lang and me["lang"] != lang: continue
-        if not _gender_ok(me.get("wants_gender", "any"), gender): continue
-        pool.append(cand)
-    if ANTI_REMATCH:
-        filtered = []
-        for cand in pool:
-            rp_cand = await _recent_rows(cand["user_id"])
-            if _recent_blocked(rp_me, cand["user_id"], now): continue
-            if _recent_blocked(rp_cand, new_user_id, now): continue
-            filtered.append(cand)
-        pool = filtered
-    if not pool: return None
-    best = max(pool, key=lambda c: _score(me, c))
-    await set_chat(new_user_id, best["user_id"])
-    return best["user_id"]
+    return {(u1, u2) for u1, u2 in rows} | {(u2, u1) for u1, u2 in rows}
+async def _commit_pairs(pairs: list[tuple[int, int]]) -> list[tuple[int, int]]:
+    if not pairs: return []
+    now = time.time()
+    async with aiosqlite.connect(SQLITE_PATH) as db:
+        # IMMEDIATE — берём write-лок сразу, чтобы очередь не поменялась между проверкой и записью
+        await db.execute("BEGIN IMMEDIATE")
+        ids = [u for p in pairs for u in p]
+        marks = ",".join("?" * len(ids))
+        async with db.execute(f"SELECT user_id FROM queue WHERE user_id IN ({marks})", ids) as cur:
+            still = {r[0] for r in await cur.fetchall()}
+        # кто-то мог выйти из очереди, пока считали раунд
+        pairs = [(a, b) for a, b in pairs if a in still and b in still]
+        await db.executemany("INSERT INTO chats(user1, user2, started_at) VALUES(?,?,?)", [(a, b, now) for a, b in pairs])
+        await db.executemany("DELETE FROM queue WHERE user_id=?", [(u,) for p in pairs for u in p])
+        if ANTI_REMATCH:
+            await db.executemany("INSERT INTO recent_pairs(user1, user2, ts) VALUES(?,?,?)",
+                                 [r for a, b in pairs for r in ((a, b, now), (b, a, now))])
+        await db.commit()
+    return pairs
+async def match_round() -> list[tuple[int, int]]:
+    """Pair the whole queue at once; all pairs are committed in a single transaction."""
+    await init_db()
+    async with aiosqlite.connect(SQLITE_PATH) as db:
+        db.row_factory = aiosqlite.Row
+        async with db.execute(f"SELECT {QUEUE_COLS} FROM queue ORDER BY ts ASC") as cur:
+            rows = [dict(r) for r in await cur.fetchall()]
+    for r in rows:
+        r["codes"] = (r.pop("interests_mask") or 0, r.pop("vibe_code") or 0, r.pop("lang_code") or 0)
+    if len(rows) < 2: return []
+    pairs = plan_pairs(rows, await _recent_set(time.time()))
+    return await _commit_pairs(pairs)
+async def run_match_rounds(on_pair: Callable[[int, int], Awaitable[Any]], interval: float = BATCH_INTERVAL):
+    while True:
+        try:
+            for a, b in await match_round():
+                try:
+                    await on_pair(a, b)
+                except Exception:
+                    logging.exception("match_sqlite: on_pair failed for %s <-> %s", a, b)
+        except Exception:
+            logging.exception("match_sqlite: batch round failed")
+        await asyncio.sleep(interval)
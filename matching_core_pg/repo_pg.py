@@ -1,6 +1,33 @@
 import time
 import asyncpg
-from typing import Optional, Sequence
+from typing import List, Optional, Sequence, Union
+
+def normalize_interests(interests: Union[str, Sequence[str], None]) -> Optional[List[str]]:
+    """List (or legacy CSV string) -> sorted unique lowercase keys for queue.interests TEXT[]."""
+    if not interests:
+        return None
+    if isinstance(interests, str):
+        interests = interests.split(",")
+    keys = sorted({str(i).strip().lower() for i in interests} - {""})
+    return keys or None
+
+async def migrate_interests(conn):
+    # old schema kept interests as a CSV TEXT column; GIN needs TEXT[]
+    dtype = await conn.fetchval(
+        "SELECT data_type FROM information_schema.columns WHERE table_name='queue' AND column_name='interests'"
+    )
+    if dtype == "text":
+        # same keys as normalize_interests: trimmed, lowercased, unique, sorted; empty -> NULL.
+        # USING can't hold a subquery, so the normalization lives in a session-local function.
+        await conn.execute(
+            "CREATE OR REPLACE FUNCTION pg_temp.normalize_interests(csv TEXT) RETURNS TEXT[] "
+            "LANGUAGE sql IMMUTABLE AS $$ "
+            "SELECT NULLIF(array(SELECT DISTINCT lower(btrim(x)) FROM unnest(string_to_array(csv, ',')) x "
+            "WHERE btrim(x) <> '' ORDER BY 1), '{}') $$"
+        )
+        await conn.execute(
+            "ALTER TABLE queue ALTER COLUMN interests TYPE TEXT[] USING pg_temp.normalize_interests(interests)"
+        )
 
 class PGRepo:
     def __init__(self, dsn: str, *, pool_min:int=1, pool_max:int=15, timeout_ms:int=5000, anti_rematch_window_sec:int=3600):
@@ -14,6 +41,7 @@ class PGRepo:
     async def init(self):
         self.pool = await asyncpg.create_pool(dsn=self.dsn, min_size=self.pool_min, max_size=self.pool_max, timeout=self.timeout_ms/1000.0)
         async with self.pool.acquire() as conn:
+            await migrate_interests(conn)
             schema_path = __file__.replace("repo_pg.py", "schema_pg.sql")
             sql = open(schema_path, "r", encoding="utf-8").read()
             for stmt in sql.split(";"):
@@ -27,12 +55,7 @@ class PGRepo:
             self.pool = None
 
     async def enqueue(self, user_id:int, *, sex=None, age=None, lang=None, interests:Optional[Sequence[str]]=None, vibe=None, adult_ok=False, is_premium=False):
-        interests_str = None
-        if interests:
-            if isinstance(interests, (list, tuple, set)):
-                interests_str = ",".join(map(str, interests))
-            else:
-                interests_str = str(interests)
+        interests_arr = normalize_interests(interests)
         now = int(time.time())
         async with self.pool.acquire() as conn:
             await conn.execute(
@@ -45,7 +68,7 @@ class PGRepo:
                   adult_ok=EXCLUDED.adult_ok, is_premium=EXCLUDED.is_premium,
                   enqueued_at=EXCLUDED.enqueued_at
                 """,
-                user_id, sex, age, lang, interests_str, vibe, bool(adult_ok), bool(is_premium), now
+                user_id, sex, age, lang, interests_arr, vibe, bool(adult_ok), bool(is_premium), now
             )
 
     async def dequeue(self, user_id:int):
@@ -62,56 +85,65 @@ class PGRepo:
 
     async def match_user(self, user_id:int, *, sex=None, age=None, lang=None, interests:Optional[Sequence[str]]=None, vibe=None, adult_ok=False, is_premium=False) -> Optional[int]:
         now = int(time.time())
-        interests_csv = None
-        if interests:
-            if isinstance(interests, (list, tuple, set)):
-                interests_csv = ",".join(map(str, interests))
-            else:
-                interests_csv = str(interests)
+        interests_arr = normalize_interests(interests)
 
         async with self.pool.acquire() as conn:
             async with conn.transaction():
                 # Remove self from queue to avoid matching ourselves
                 await conn.execute("DELETE FROM queue WHERE user_id=$1", user_id)
 
-                row = await conn.fetchrow(
-                    """
+                # Only the predicates actually in use go into the SQL: with "$n IS NULL OR ..."
+                # a generic prepared plan can't use the (lang, sex, ...) composite indexes.
+                params: list = [user_id, now - self.window]
+                where = ["q.user_id <> $1"]
+                def arg(v):
+                    params.append(v)
+                    return f"${len(params)}"
+                if lang is not None:
+                    where.append(f"q.lang = {arg(lang)}")
+                if sex is not None:
+                    where.append(f"q.sex = {arg(sex)}")
+                if isinstance(age, int):
+                    where.append(f"q.age BETWEEN {arg(age - 2)} AND {arg(age + 2)}")
+                if adult_ok:
+                    where.append("q.adult_ok = true")
+                if vibe is not None:
+                    where.append(f"q.vibe = {arg(vibe)}")
+                sql = """
                     SELECT q.user_id
                     FROM queue q
-                    WHERE q.user_id <> $1
-                      AND ($2::text IS NULL OR q.sex = $2)
-                      AND ($3::text IS NULL OR q.lang = $3)
-                      AND ($4::bool = false OR q.adult_ok = true)
-                      AND ($5::text IS NULL OR q.vibe = $5)
-                      AND ($6::int IS NULL OR q.age BETWEEN $7 AND $8)
-                      AND (
-                        $9::text IS NULL OR q.interests IS NULL OR POSITION(','||$9||',' IN ','||q.interests||',') > 0
-                      )
+                    WHERE {where}
                       AND NOT EXISTS (
                         SELECT 1 FROM recent_pairs rp
-                        WHERE rp.a_id = $1 AND rp.b_id = q.user_id AND rp.matched_at > $10
+                        WHERE rp.a_id = $1 AND rp.b_id = q.user_id AND rp.matched_at > $2
                       )
-                    ORDER BY q.is_premium DESC, q.enqueued_at
+                    ORDER BY {order}q.is_premium DESC, q.enqueued_at
                     FOR UPDATE SKIP LOCKED
                     LIMIT 1
-                    """,
-                    user_id,
-                    sex,
-                    lang,
-                    bool(adult_ok),
-                    vibe,
-                    age if isinstance(age, int) else None,
-                    (age - 2) if isinstance(age, int) else None,
-                    (age + 2) if isinstance(age, int) else None,
-                    interests_csv,
-                    now - self.window,
-                )
+                    """
+                base = " AND ".join(where)
+                row = None
+                if interests_arr is not None:
+                    # 1) overlapping interests via the GIN index, most shared interests first
+                    n = arg(interests_arr)
+                    row = await conn.fetchrow(sql.format(
+                        where=f"{base} AND q.interests && {n}::text[]",
+                        order=f"cardinality(ARRAY(SELECT unnest(q.interests) INTERSECT SELECT unnest({n}::text[]))) DESC, ",
+                    ), *params)
+                    if not row:
+                        # 2) candidates without interests are still acceptable, as before
+                        params.pop()
+                        row = await conn.fetchrow(sql.format(
+                            where=f"{base} AND (q.interests IS NULL OR q.interests = '{{}}')", order="",
+                        ), *params)
+                else:
+                    row = await conn.fetchrow(sql.format(where=base, order=""), *params)
 
                 if not row:
                     # No partner — put self back into queue
                     await conn.execute(
                         "INSERT INTO queue(user_id, sex, age, lang, interests, vibe, adult_ok, is_premium, enqueued_at) VALUES ($1,$2,$3,$4,$5,$6,$7,$8,$9) ON CONFLICT (user_id) DO UPDATE SET sex=EXCLUDED.sex, age=EXCLUDED.age, lang=EXCLUDED.lang, interests=EXCLUDED.interests, vibe=EXCLUDED.vibe, adult_ok=EXCLUDED.adult_ok, is_premium=EXCLUDED.is_premium, enqueued_at=EXCLUDED.enqueued_at",
-                        user_id, sex, age, lang, interests_csv, vibe, bool(adult_ok), bool(is_premium), now
+                        user_id, sex, age, lang, interests_arr, vibe, bool(adult_ok), bool(is_premium), now
                     )
                     return None
 
@@ -3,17 +3,21 @@ CREATE TABLE IF NOT EXISTS queue (
   sex         TEXT,
   age         INT,
   lang        TEXT,
-  interests   TEXT,
+  interests   TEXT[],
   vibe        TEXT,
   adult_ok    BOOLEAN DEFAULT FALSE,
   is_premium  BOOLEAN DEFAULT FALSE,
   enqueued_at BIGINT NOT NULL
 );
 CREATE INDEX IF NOT EXISTS idx_queue_enqueued ON queue(enqueued_at);
-CREATE INDEX IF NOT EXISTS idx_queue_premium ON queue(is_premium);
-CREATE INDEX IF NOT EXISTS idx_queue_sex ON queue(sex);
-CREATE INDEX IF NOT EXISTS idx_queue_lang ON queue(lang);
-CREATE INDEX IF NOT EXISTS idx_queue_age ON queue(age);
+-- queue is insert/delete-heavy: one index per access path of match_user (plans: bench_match_pg.py).
+-- lang/sex equality, read in ORDER BY is_premium DESC, enqueued_at order: LIMIT 1 stops
+-- at the first row passing the age (and adult_ok) filter, no sort
+CREATE INDEX IF NOT EXISTS idx_queue_lang_sex_order ON queue(lang, sex, is_premium DESC, enqueued_at);
+-- searches without a gender filter (adult searches too: adult_ok is a filter on this scan)
+CREATE INDEX IF NOT EXISTS idx_queue_lang_order ON queue(lang, is_premium DESC, enqueued_at);
+-- interests overlap (q.interests && $n::text[])
+CREATE INDEX IF NOT EXISTS idx_queue_interests ON queue USING GIN (interests);
 
 CREATE TABLE IF NOT EXISTS pairs (
   a_id       BIGINT NOT NULL,
@@ -31,5 +35,16 @@ CREATE TABLE IF NOT EXISTS recent_pairs (
   matched_at BIGINT NOT NULL,
   PRIMARY KEY (a_id, b_id)
 );
-CREATE INDEX IF NOT EXISTS idx_recent_a ON recent_pairs(a_id);
 CREATE INDEX IF NOT EXISTS idx_recent_b ON recent_pairs(b_id);
+-- the anti-rematch probe (a_id, b_id) is served by the primary key: at most one row
+
+-- superseded by the composite indexes above
+DROP INDEX IF EXISTS idx_queue_premium;
+DROP INDEX IF EXISTS idx_queue_sex;
+DROP INDEX IF EXISTS idx_queue_lang;
+DROP INDEX IF EXISTS idx_queue_age;
+DROP INDEX IF EXISTS idx_recent_a;
+-- redundant with idx_queue_lang_sex_order / idx_queue_lang_order / the recent_pairs key
+DROP INDEX IF EXISTS idx_queue_lang_sex_age;
+DROP INDEX IF EXISTS idx_queue_adult_order;
+DROP INDEX IF EXISTS idx_recent_a_b_time;
@@ -0,0 +1,253 @@
+# matchmaker.py — in-process matchmaker: pairs searching users on enqueue + one shared tick
+import asyncio
+import logging
+import time
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Iterator, Optional
+
+log = logging.getLogger("matchmaker")
+
+AGE_RANGE = 2          # как было в find_partner: age ± 2
+AGE_BAND = 2 * AGE_RANGE + 1  # ширина возрастной корзины: окно ±AGE_RANGE задевает максимум 2 корзины
+MIN_RATING = 0         # как было в find_partner: min_rating=0
+RELAX_AFTER = 3.0      # через сколько секунд ожидания разрешаем «мягкий» подбор
+TICK_INTERVAL = 1.0    # общий тик планировщика (один на процесс)
+
+
+@dataclass(slots=True)
+class SearchTicket:
+    """Snapshot of a searching user's profile, taken once at enqueue time."""
+    user_id: int
+    language: str
+    age: int
+    gender: Optional[str]
+    vibe: str = ""
+    rating: int = 0
+    gender_filter: Optional[str] = None
+    enqueued_at: float = field(default_factory=time.monotonic)
+
+    @classmethod
+    def from_user_row(cls, user_id: int, row, gender_filter: Optional[str] = None) -> "SearchTicket":
+        # row — кортеж из database.get_user: 0 gender, 1 age, 2 language, 5 rating, 8 vibe
+        return cls(
+            user_id=user_id,
+            language=(row[2] or "ru"),
+            age=(row[1] or 18),
+            gender=row[0],
+            vibe=((row[8] or "") if len(row) > 8 else "").strip().lower(),
+            rating=((row[5] or 0) if len(row) > 5 else 0),
+            gender_filter=gender_filter,
+        )
+
+
+def _gender_ok(me: SearchTicket, other: SearchTicket) -> bool:
+    return me.gender_filter is None or me.gender_filter == other.gender
+
+
+def compatible(a: SearchTicket, b: SearchTicket, *, relaxed: bool = False) -> bool:
+    """Mutual compatibility check. Relaxed mode keeps only the gender preferences."""
+    if a.user_id == b.user_id:
+        return False
+    if not (_gender_ok(a, b) and _gender_ok(b, a)):
+        return False
+    if relaxed:
+        return True
+    if a.language != b.language:
+        return False
+    if abs(a.age - b.age) > AGE_RANGE:
+        return False
+    if a.vibe and b.vibe and a.vibe != b.vibe:
+        return False
+    return a.rating >= MIN_RATING and b.rating >= MIN_RATING
+
+
+BucketKey = tuple[str, Optional[str], Optional[str], int, str]
+
+
+def _age_band(age: int) -> int:
+    return age // AGE_BAND
+
+
+def _bucket_key(t: SearchTicket) -> BucketKey:
+    return (t.language, t.gender, t.gender_filter, _age_band(t.age), t.vibe)
+
+
+class WaitingIndex:
+    """
+    Waiting pool bucketed by (language, gender, gender filter, age band, vibe).
+
+    add/remove are O(1). Strict find() probes only the buckets that can hold a
+    compatible partner and gives up on a bucket at its first entry with incompatible
+    gender preferences (those are the same for the whole bucket), so lookup cost
+    depends on the number of buckets, not on queue length. Relaxed find() only checks
+    gender preferences, so the pool is also kept per (gender, gender filter) — at most
+    9 groups, each compatible or not as a whole — and it looks at the head of each.
+    Buckets and groups are insertion-ordered dicts, so the first hit in one is its
+    oldest compatible entry; across them the longest-waiting candidate wins.
+    """
+
+    def __init__(self):
+        self._tickets: dict[int, SearchTicket] = {}
+        self._buckets: dict[BucketKey, dict[int, SearchTicket]] = {}
+        # (language, age band) -> ключи непустых корзин; нужно, чтобы не перебирать все корзины
+        self._keys_by_band: dict[tuple[str, int], set[BucketKey]] = {}
+        # (gender, gender filter) -> ожидающие в порядке прихода; для мягкого подбора
+        self._by_gender: dict[tuple[Optional[str], Optional[str]], dict[int, SearchTicket]] = {}
+
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self._tickets
+
+    def __len__(self) -> int:
+        return len(self._tickets)
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self._tickets)
+
+    def get(self, user_id: int) -> Optional[SearchTicket]:
+        return self._tickets.get(user_id)
+
+    def add(self, ticket: SearchTicket) -> None:
+        self.remove(ticket.user_id)
+        key = _bucket_key(ticket)
+        self._tickets[ticket.user_id] = ticket
+        self._buckets.setdefault(key, {})[ticket.user_id] = ticket
+        self._keys_by_band.setdefault((key[0], key[3]), set()).add(key)
+        self._by_gender.setdefault((key[1], key[2]), {})[ticket.user_id] = ticket
+
+    def remove(self, user_id: int) -> Optional[SearchTicket]:
+        ticket = self._tickets.pop(user_id, None)
+        if ticket is None:
+            return None
+        key = _bucket_key(ticket)
+        group = self._by_gender[(key[1], key[2])]
+        del group[user_id]
+        if not group:
+            del self._by_gender[(key[1], key[2])]
+        bucket = self._buckets[key]
+        del bucket[user_id]
+        if not bucket:
+            del self._buckets[key]
+            keys = self._keys_by_band[(key[0], key[3])]
+            keys.discard(key)
+            if not keys:
+                del self._keys_by_band[(key[0], key[3])]
+        return ticket
+
+    def _candidate_keys(self, me: SearchTicket) -> Iterator[BucketKey]:
+        lo, hi = _age_band(me.age - AGE_RANGE), _age_band(me.age + AGE_RANGE)
+        for band in range(lo, hi + 1):
+            for key in self._keys_by_band.get((me.language, band), ()):
+                _, gender, wants, _, vibe = key
+                if me.gender_filter is not None and gender != me.gender_filter:
+                    continue
+                if wants is not None and wants != me.gender:
+                    continue
+                if me.vibe and vibe and vibe != me.vibe:
+                    continue
+                yield key
+
+    def _find_relaxed(self, me: SearchTicket) -> Optional[SearchTicket]:
+        best: Optional[SearchTicket] = None
+        for (gender, wants), group in self._by_gender.items():
+            if me.gender_filter is not None and gender != me.gender_filter:
+                continue
+            if wants is not None and wants != me.gender:
+                continue
+            for cand in group.values():
+                if cand.user_id != me.user_id:
+                    if best is None or cand.enqueued_at < best.enqueued_at:
+                        best = cand
+                    break
+        return best
+
+    def find(self, me: SearchTicket, *, relaxed: bool = False) -> Optional[SearchTicket]:
+        if relaxed:
+            return self._find_relaxed(me)
+        best: Optional[SearchTicket] = None
+        for key in self._candidate_keys(me):
+            for cand in self._buckets[key].values():
+                if cand.user_id == me.user_id:
+                    continue
+                if not (_gender_ok(me, cand) and _gender_ok(cand, me)):
+                    break  # пол и фильтр пола у всей корзины общие — дальше смотреть незачем
+                if compatible(me, cand):
+                    if best is None or cand.enqueued_at < best.enqueued_at:
+                        best = cand
+                    break
+        return best
+
+
+class Matchmaker:
+    """
+    Central waiting pool for the bot process.
+
+    enqueue() pairs the user immediately if a compatible partner is already waiting;
+    otherwise the user stays in the pool and the shared run() tick retries everyone
+    who has waited longer than relax_after with relaxed criteria.
+    on_match(uid, pid) is awaited for every pair produced.
+    """
+
+    def __init__(
+        self,
+        on_match: Callable[[int, int], Awaitable[None]],
+        *,
+        tick: float = TICK_INTERVAL,
+        relax_after: float = RELAX_AFTER,
+    ):
+        self._on_match = on_match
+        self._tick = tick
+        self._relax_after = relax_after
+        self._waiting = WaitingIndex()
+
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self._waiting
+
+    def __len__(self) -> int:
+        return len(self._waiting)
+
+    def cancel(self, user_id: int) -> None:
+        self._waiting.remove(user_id)
+
+    async def enqueue(self, ticket: SearchTicket) -> Optional[int]:
+        """Add the user to the pool; returns partner_id if a pair was made right away."""
+        self._waiting.remove(ticket.user_id)
+        partner = self._waiting.find(ticket)
+        if partner is None:
+            self._waiting.add(ticket)
+            return None
+        self._waiting.remove(partner.user_id)
+        await self._emit(ticket.user_id, partner.user_id)
+        return partner.user_id
+
+    async def _emit(self, uid: int, pid: int) -> None:
+        try:
+            await self._on_match(uid, pid)
+        except Exception:
+            log.exception("on_match failed for %s <-> %s", uid, pid)
+
+    async def match_pending(self) -> int:
+        """One scheduler pass over everybody still waiting. Returns number of pairs made."""
+        now = time.monotonic()
+        made = 0
+        for uid in list(self._waiting):
+            me = self._waiting.get(uid)
+            if me is None or now - me.enqueued_at < self._relax_after:
+                continue  # уже спарен на этом проходе / ещё рано смягчать
+            # строгий подбор симметричен и уже был сделан в enqueue() — здесь только мягкий
+            partner = self._waiting.find(me, relaxed=True)
+            if partner is None:
+                continue
+            self._waiting.remove(uid)
+            self._waiting.remove(partner.user_id)
+            made += 1
+            await self._emit(uid, partner.user_id)
+        return made
+
+    async def run(self) -> None:
+        while True:
+            try:
+                if len(self._waiting) > 1:
+                    await self.match_pending()
+            except Exception:
+                log.exception("matchmaker tick failed")
+            await asyncio.sleep(self._tick)
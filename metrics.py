@@ -0,0 +1,164 @@
+# metrics.py — счётчики бота в памяти процесса: обновляются по событиям, отдаются как JSON и Prometheus
+import time
+from collections import deque
+from datetime import date
+from typing import Callable, Optional
+
+PREFIX = "neverland_"
+
+
+class Counter:
+    __slots__ = ("name", "help", "value", "_fn")
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, fn: Optional[Callable[[], float]] = None):
+        self.name, self.help, self.value, self._fn = name, help, 0, fn
+
+    def inc(self, n: float = 1) -> None:
+        self.value += n
+
+    def get(self) -> float:
+        return self._fn() if self._fn else self.value
+
+
+class Gauge(Counter):
+    __slots__ = ()
+    kind = "gauge"
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+    def dec(self, n: float = 1) -> None:
+        self.value -= n
+
+
+class DailyCounter(Counter):
+    """
+    Counter that starts from zero every local day (matches today, ...).
+    After a restart it starts at zero mid-day; seed() sets it once from the database.
+    """
+    __slots__ = ("_day", "seeded")
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str):
+        super().__init__(name, help)
+        self._day = date.today()
+        self.seeded = False
+
+    def seed(self, value: float) -> None:
+        # max: события, посчитанные до прихода значения из БД, в нём уже есть
+        self._roll()
+        self.value = max(self.value, value)
+        self.seeded = True
+
+    def _roll(self) -> None:
+        today = date.today()
+        if today != self._day:
+            self._day, self.value = today, 0
+
+    def inc(self, n: float = 1) -> None:
+        self._roll()
+        self.value += n
+
+    def get(self) -> float:
+        self._roll()
+        return self.value
+
+
+class Rate:
+    """
+    Events per `per` seconds (1 — per second, 60 — per minute) over a sliding window,
+    kept as one bucket per second, so mark() and get() are O(1) amortised.
+    """
+    __slots__ = ("name", "help", "window", "per", "_buckets", "_sum")
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, window: int = 60, per: float = 1.0):
+        self.name, self.help, self.window, self.per = name, help, window, per
+        self._buckets: deque[list] = deque()  # [секунда, количество]
+        self._sum = 0
+
+    def _trim(self, now: int) -> None:
+        while self._buckets and self._buckets[0][0] <= now - self.window:
+            self._sum -= self._buckets.popleft()[1]
+
+    def mark(self, n: int = 1) -> None:
+        now = int(time.monotonic())
+        if self._buckets and self._buckets[-1][0] == now:
+            self._buckets[-1][1] += n
+        else:
+            self._buckets.append([now, n])
+        self._sum += n
+        self._trim(now)
+
+    def get(self) -> float:
+        """Average rate over the last `window` seconds."""
+        self._trim(int(time.monotonic()))
+        return self._sum / self.window * self.per
+
+
+class Registry:
+    """
+    Named metrics of this process plus the last snapshots pushed by other processes
+    (shard workers). snapshot()/prometheus() add those up, so the coordinator's
+    stats server shows cluster-wide numbers.
+    """
+
+    def __init__(self):
+        self._metrics: dict[str, Counter | Rate] = {}
+        self._remote: dict[str, tuple[float, dict[str, float]]] = {}
+
+    def _add(self, metric):
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, fn: Optional[Callable[[], float]] = None) -> Counter:
+        return self._add(Counter(name, help, fn))
+
+    def gauge(self, name: str, help: str, fn: Optional[Callable[[], float]] = None) -> Gauge:
+        return self._add(Gauge(name, help, fn))
+
+    def daily(self, name: str, help: str) -> DailyCounter:
+        return self._add(DailyCounter(name, help))
+
+    def rate(self, name: str, help: str, window: int = 60, per: float = 1.0) -> Rate:
+        return self._add(Rate(name, help, window, per))
+
+    def seed(self, name: str, value: float) -> bool:
+        """Seed the daily counter `name` from a persisted total, once; False if nothing to seed."""
+        m = self._metrics.get(name)
+        if not isinstance(m, DailyCounter) or m.seeded:
+            return False
+        m.seed(value)
+        return True
+
+    def local(self) -> dict[str, float]:
+        return {name: m.get() for name, m in self._metrics.items()}
+
+    def absorb(self, source: str, values: dict[str, float]) -> None:
+        """Store the latest local() of another process under `source`."""
+        self._remote[source] = (time.monotonic(), values)
+
+    def snapshot(self, stale_after: float = 30.0) -> dict[str, float]:
+        total = self.local()
+        now = time.monotonic()
+        for at, values in self._remote.values():
+            if now - at > stale_after:
+                continue  # воркер пропал — его цифры не суммируем
+            for name, v in values.items():
+                total[name] = total.get(name, 0) + v
+        return {name: round(v, 4) for name, v in total.items()}
+
+    def prometheus(self) -> str:
+        values = self.snapshot()
+        lines = []
+        for name, v in values.items():
+            m = self._metrics.get(name)
+            if m is not None:
+                lines.append(f"# HELP {PREFIX}{name} {m.help}")
+                lines.append(f"# TYPE {PREFIX}{name} {m.kind}")
+            lines.append(f"{PREFIX}{name} {v:g}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Registry()
@@ -0,0 +1,82 @@
+# relay.py — сборка альбомов (media group) для пересылки одним copy_messages
+import asyncio
+import logging
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable
+
+log = logging.getLogger("relay")
+
+ALBUM_WINDOW = 0.6   # сек.: Telegram присылает части альбома отдельными апдейтами почти подряд
+ALBUM_MAX = 10       # в альбоме не больше 10 элементов
+
+
+@dataclass(slots=True)
+class _Album:
+    to_chat: int
+    from_chat: int
+    message_ids: list[int] = field(default_factory=list)
+    timer: asyncio.TimerHandle | None = None
+
+
+class MediaGroupBuffer:
+    """
+    Collects the parts of one media group and hands them to flush() as a single batch.
+
+    Each part restarts a short timer; when no new part arrives within `window`
+    (or the album is full) flush(to_chat, from_chat, sorted_message_ids) is called once.
+    flush_from() sends a chat's albums early, so a caption typed right after an album
+    is not delivered before it.
+    """
+
+    def __init__(self, flush: Callable[[int, int, list[int]], Awaitable[None]], *, window: float = ALBUM_WINDOW):
+        self._flush = flush
+        self._window = window
+        self._albums: dict[str, _Album] = {}
+        self._tasks: set[asyncio.Task] = set()  # держим ссылки, иначе GC может снять задачу посреди отправки
+
+    def add(self, media_group_id: str, to_chat: int, from_chat: int, message_id: int) -> None:
+        album = self._albums.get(media_group_id)
+        if album is None:
+            album = self._albums[media_group_id] = _Album(to_chat, from_chat)
+        album.message_ids.append(message_id)
+        if album.timer:
+            album.timer.cancel()
+        if len(album.message_ids) >= ALBUM_MAX:
+            album.timer = None
+            self._spawn(media_group_id)
+        else:
+            album.timer = asyncio.get_running_loop().call_later(self._window, self._spawn, media_group_id)
+
+    def _spawn(self, media_group_id: str) -> None:
+        task = asyncio.create_task(self._fire(media_group_id))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def _take(self, from_chat: int) -> list[str]:
+        ids = [gid for gid, album in self._albums.items() if album.from_chat == from_chat]
+        for gid in ids:
+            if self._albums[gid].timer:
+                self._albums[gid].timer.cancel()
+        return ids
+
+    async def flush_from(self, from_chat: int) -> None:
+        """Send the pending albums of `from_chat` now: before its next message or when its chat ends."""
+        for gid in self._take(from_chat):
+            await self._fire(gid)
+
+    def drop_from(self, from_chat: int) -> None:
+        """Forget the pending albums of `from_chat` (its partner has left)."""
+        for gid in self._take(from_chat):
+            del self._albums[gid]
+
+    async def _fire(self, media_group_id: str) -> None:
+        album = self._albums.pop(media_group_id, None)
+        if album is None:
+            return
+        try:
+            await self._flush(album.to_chat, album.from_chat, sorted(album.message_ids))
+        except Exception:
+            log.exception("album %s flush failed", media_group_id)
+
+    def __len__(self) -> int:
+        return len(self._albums)
@@ -0,0 +1,281 @@
+# sender.py — планировщик исходящих сообщений: token bucket на чат и глобально, RetryAfter, приоритеты
+import asyncio
+import heapq
+import logging
+import os
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Optional
+
+from aiogram.exceptions import TelegramRetryAfter
+
+log = logging.getLogger("sender")
+
+# лимиты Telegram: ~30 сообщений/сек на бота и ~1/сек в один чат (короткий всплеск допускается)
+GLOBAL_RATE = float(os.getenv("SEND_GLOBAL_RATE", "30"))
+GLOBAL_BURST = float(os.getenv("SEND_GLOBAL_BURST", "5"))  # небольшой: полный bucket на 30 = 60 сообщений за первую секунду
+CHAT_RATE = float(os.getenv("SEND_CHAT_RATE", "1"))
+CHAT_BURST = float(os.getenv("SEND_CHAT_BURST", "3"))
+MAX_QUEUE = int(os.getenv("SEND_MAX_QUEUE", "10000"))
+MAX_IN_FLIGHT = int(os.getenv("SEND_MAX_IN_FLIGHT", "64"))
+MAX_RETRIES = int(os.getenv("SEND_MAX_RETRIES", "5"))
+RESTART_DELAY = 1.0  # сек.: пауза перед перезапуском упавшего run()
+
+# полосы приоритета: меньше — раньше
+RELAY = 0    # сообщения собеседнику
+REPLY = 1    # ответы на действия пользователя
+NOTICE = 2   # системные уведомления (partner_left, chat_found, ...)
+LANES = (RELAY, REPLY, NOTICE)
+
+
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = max(1.0, burst)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now: float) -> float:
+        """Seconds until one token is available (0 if available now)."""
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now: float) -> None:
+        self._refill(now)
+        self.tokens -= 1
+
+    def full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.burst
+
+
+@dataclass(slots=True)
+class _Job:
+    call: Callable[[], Awaitable[Any]]
+    priority: int
+    future: asyncio.Future
+    enqueued_at: float = field(default_factory=time.monotonic)
+    attempts: int = 0
+
+
+class SendScheduler:
+    """
+    Single outbound path for bot messages.
+
+    Jobs are zero-argument coroutine factories, so a flood-waited send can simply be
+    called again. Each chat has a FIFO of jobs (relay order is preserved) and its own
+    token bucket; a global bucket caps the bot as a whole. Ready chats are served by
+    lane: RELAY before REPLY before NOTICE. On TelegramRetryAfter the job goes back to
+    the head of its chat queue and the chat sleeps for retry_after seconds.
+    At most max_queue jobs are pending; send() waits for room beyond that.
+    start() runs the loop in the background and restarts it if it ever dies, so a
+    bug in the loop is logged instead of leaving every send() waiting forever.
+    """
+
+    def __init__(
+        self,
+        *,
+        global_rate: float = GLOBAL_RATE,
+        global_burst: float = GLOBAL_BURST,
+        chat_rate: float = CHAT_RATE,
+        chat_burst: float = CHAT_BURST,
+        max_queue: int = MAX_QUEUE,
+        max_in_flight: int = MAX_IN_FLIGHT,
+        max_retries: int = MAX_RETRIES,
+    ):
+        self._global = TokenBucket(global_rate, global_burst)
+        self._chat_rate = chat_rate
+        self._chat_burst = chat_burst
+        self._max_retries = max_retries
+        self._max_in_flight = max_in_flight
+        self._space = asyncio.Semaphore(max_queue)
+        self._slots = asyncio.Semaphore(max_in_flight)
+        self._chats: dict[int, deque[_Job]] = {}
+        self._buckets: dict[int, TokenBucket] = {}
+        self._ready: dict[int, deque[int]] = {lane: deque() for lane in LANES}
+        self._scheduled: set[int] = set()          # чаты в _ready или _delayed
+        self._delayed: list[tuple[float, int]] = []  # (когда, chat_id) — ждут свой bucket / RetryAfter
+        self._in_flight: set[int] = set()
+        self._wake = asyncio.Event()
+        self._runner: Optional[asyncio.Task] = None
+        self._deliveries: set[asyncio.Task] = set()
+        self.max_queue = max_queue
+        self.sent = 0
+        self.failed = 0
+        self.retry_after = 0
+        self.pending = 0
+        self.restarts = 0
+        self.wait_total = 0.0  # суммарное ожидание в очереди, для среднего
+
+    # ---------- публичное API ----------
+    async def send(self, chat_id: int, call: Callable[[], Awaitable[Any]], *, priority: int = NOTICE) -> Any:
+        """Queue a send and wait for its result; exceptions (e.g. TelegramForbiddenError) propagate."""
+        self.start()
+        await self._space.acquire()
+        job = _Job(call, priority, asyncio.get_running_loop().create_future())
+        self.pending += 1
+        self._chats.setdefault(chat_id, deque()).append(job)
+        self._schedule(chat_id)
+        return await job.future
+
+    def start(self) -> asyncio.Task:
+        """Run the scheduler loop in the background (idempotent); cancel the task to stop it."""
+        if self._runner is None or self._runner.done():
+            self._runner = asyncio.create_task(self.run())
+            self._runner.add_done_callback(self._runner_done)
+        return self._runner
+
+    def set_global_rate(self, rate: float, burst: float) -> None:
+        """Re-cap the whole-bot bucket, e.g. to one shard's share of the Telegram limit."""
+        self._global = TokenBucket(rate, burst)
+
+    def stats(self) -> dict:
+        return {
+            "pending": self.pending,
+            "max_queue": self.max_queue,
+            "in_flight": len(self._in_flight),
+            "ready_by_lane": {lane: len(q) for lane, q in self._ready.items()},
+            "delayed_chats": len(self._delayed),
+            "sent": self.sent,
+            "failed": self.failed,
+            "retry_after": self.retry_after,
+            "restarts": self.restarts,
+            "avg_wait_ms": round(self.wait_total / self.sent * 1000, 2) if self.sent else 0.0,
+        }
+
+    # ---------- внутреннее ----------
+    def _runner_done(self, task: asyncio.Task) -> None:
+        if task.cancelled():
+            return  # остановлен намеренно (завершение процесса)
+        log.error("send scheduler loop died, restarting in %ss", RESTART_DELAY, exc_info=task.exception())
+        self.restarts += 1
+        self._recover()
+        asyncio.get_running_loop().call_later(RESTART_DELAY, self.start)
+
+    def _recover(self) -> None:
+        # цикл мог упасть посреди шага: пересобираем очереди готовности из очередей чатов
+        delayed = {chat_id: at for at, chat_id in self._delayed}  # RetryAfter и bucket-паузы сохраняем
+        self._ready = {lane: deque() for lane in LANES}
+        self._delayed.clear()
+        self._scheduled.clear()
+        self._slots = asyncio.Semaphore(max(0, self._max_in_flight - len(self._in_flight)))
+        for chat_id in list(self._chats):
+            self._schedule(chat_id, delayed.get(chat_id, 0.0))
+
+    def _schedule(self, chat_id: int, at: float = 0.0) -> None:
+        if chat_id in self._scheduled or chat_id in self._in_flight or not self._chats.get(chat_id):
+            return
+        self._scheduled.add(chat_id)
+        if at > time.monotonic():
+            heapq.heappush(self._delayed, (at, chat_id))
+        else:
+            self._ready[self._chats[chat_id][0].priority].append(chat_id)
+        self._wake.set()
+
+    def _bucket(self, chat_id: int) -> TokenBucket:
+        b = self._buckets.get(chat_id)
+        if b is None:
+            b = self._buckets[chat_id] = TokenBucket(self._chat_rate, self._chat_burst)
+        return b
+
+    def _pop_ready(self) -> Optional[int]:
+        for lane in LANES:
+            if self._ready[lane]:
+                return self._ready[lane].popleft()
+        return None
+
+    def _prune(self, now: float) -> None:
+        # bucket простаивающего чата уже полон — его можно забыть без потери точности
+        for chat_id in [c for c, b in self._buckets.items() if c not in self._chats and b.full(now)]:
+            del self._buckets[chat_id]
+
+    async def run(self) -> None:
+        last_prune = time.monotonic()
+        while True:
+            now = time.monotonic()
+            while self._delayed and self._delayed[0][0] <= now:
+                _, chat_id = heapq.heappop(self._delayed)
+                self._ready[self._chats[chat_id][0].priority].append(chat_id)
+            if now - last_prune > 60:
+                self._prune(now)
+                last_prune = now
+
+            chat_id = self._pop_ready()
+            if chat_id is None:
+                self._wake.clear()
+                timeout = self._delayed[0][0] - now if self._delayed else None
+                try:
+                    await asyncio.wait_for(self._wake.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            bucket = self._bucket(chat_id)
+            chat_wait = bucket.wait_time(now)
+            if chat_wait > 0:
+                heapq.heappush(self._delayed, (now + chat_wait, chat_id))
+                continue
+            global_wait = self._global.wait_time(now)
+            if global_wait > 0:
+                self._ready[self._chats[chat_id][0].priority].appendleft(chat_id)
+                await asyncio.sleep(global_wait)
+                continue
+
+            await self._slots.acquire()
+            now = time.monotonic()
+            bucket.take(now)
+            self._global.take(now)
+            self._scheduled.discard(chat_id)
+            job = self._chats[chat_id].popleft()
+            self._in_flight.add(chat_id)
+            task = asyncio.create_task(self._deliver(chat_id, job))
+            self._deliveries.add(task)
+            task.add_done_callback(self._deliveries.discard)
+
+    async def _deliver(self, chat_id: int, job: _Job) -> None:
+        retry_at = 0.0
+        try:
+            job.attempts += 1
+            result = await job.call()
+        except TelegramRetryAfter as e:
+            self.retry_after += 1
+            if job.attempts > self._max_retries:
+                self._finish(job, exc=e)
+            else:
+                self._chats[chat_id].appendleft(job)
+                retry_at = time.monotonic() + e.retry_after
+                log.warning("flood wait %ss for chat %s (attempt %s)", e.retry_after, chat_id, job.attempts)
+        except Exception as e:
+            self._finish(job, exc=e)
+        else:
+            self._finish(job, result=result)
+        finally:
+            self._in_flight.discard(chat_id)
+            self._slots.release()
+            if self._chats.get(chat_id):
+                self._schedule(chat_id, retry_at)
+            else:
+                self._chats.pop(chat_id, None)
+
+    def _finish(self, job: _Job, *, result: Any = None, exc: Optional[BaseException] = None) -> None:
+        self.pending -= 1
+        self._space.release()
+        if exc is None:
+            self.sent += 1
+            self.wait_total += time.monotonic() - job.enqueued_at
+            if not job.future.done():
+                job.future.set_result(result)
+        else:
+            self.failed += 1
+            if not job.future.done():
+                job.future.set_exception(exc)
+
+
+sender = SendScheduler()
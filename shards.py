@@ -0,0 +1,346 @@
+# shards.py — несколько процессов-воркеров: апдейты и состояние делятся по user_id % BOT_SHARDS
+#
+# BOT_SHARDS=1 (по умолчанию) — всё как раньше, в одном процессе.
+# BOT_SHARDS=N — запущенный процесс становится координатором: он один читает апдейты
+# (polling или вебхук; Telegram отдаёт боту один поток), держит общий Matchmaker и
+# запускает N воркеров (тот же скрипт с BOT_SHARD_ID=k). Воркер k обрабатывает апдейты
+# своих пользователей и хранит их active_chats / searching_users; всё, что касается
+# чужого пользователя (релей собеседнику, partner_left, chat_found), уходит владельцу
+# через координатор по локальному TCP (JSON построчно).
+import asyncio
+import json
+import logging
+import os
+import sys
+from dataclasses import asdict
+from typing import Any, Awaitable, Callable, Optional
+
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+
+from matchmaker import SearchTicket
+from metrics import metrics
+
+log = logging.getLogger("shards")
+
+SHARDS = max(1, int(os.getenv("BOT_SHARDS", "1")))
+SHARD_ID = os.getenv("BOT_SHARD_ID")            # выставляет координатор своим воркерам
+IPC_HOST = os.getenv("BOT_IPC_HOST", "127.0.0.1")
+IPC_PORT = int(os.getenv("BOT_IPC_PORT", "8790"))
+SHARD_CONCURRENCY = int(os.getenv("BOT_SHARD_CONCURRENCY", "64"))  # апдейтов в работе на воркер
+BACKLOG_MAX = 10000                              # очередь на линк; полна — приём апдейтов ждёт
+RECONNECT_TRIES = 30
+METRICS_PUSH = 2.0                               # сек.: воркер отправляет свои метрики координатору
+RESPAWN_DELAY = 1.0
+POLL_TIMEOUT = 25
+
+
+def shard_of(user_id: int, shards: int) -> int:
+    return user_id % shards
+
+
+def update_user_id(update: Update) -> Optional[int]:
+    """The user an update belongs to (None for the rare update types without one)."""
+    try:
+        user = getattr(update.event, "from_user", None)
+    except Exception:
+        return None
+    return user.id if user else None
+
+
+def _line(payload: dict) -> bytes:
+    return json.dumps(payload, separators=(",", ":")).encode() + b"\n"
+
+
+class Cluster:
+    """
+    This process's view of the shard layout.
+
+    Code that touches another user's state goes through call(uid, name, *args): the
+    handler registered with @cluster.action(name) runs here if this shard owns uid,
+    otherwise the call is forwarded to the owner. Searches go through enqueue()/cancel(),
+    which reach the single Matchmaker living in the coordinator (or in this process
+    when running unsharded). Remote calls are fire-and-forget.
+
+    Every link (coordinator → worker k, worker → coordinator) has a bounded outbox
+    drained by one pump task that writes and awaits drain(). Messages wait in it while
+    the link is down and are sent once it is back; when it is full, senders wait — so
+    a slow worker holds up polling / the webhook queue instead of growing a buffer.
+    """
+
+    def __init__(self, shards: int = SHARDS, shard_id: Optional[str] = SHARD_ID):
+        self.shards = shards
+        if shard_id is not None:
+            self.role, self.shard = "worker", int(shard_id)
+        elif shards > 1:
+            self.role, self.shard = "coordinator", -1
+        else:
+            self.role, self.shard = "single", 0
+        self._actions: dict[str, Callable[..., Awaitable[Any]]] = {}
+        self._matchmaker = None
+        self._links: dict[int, asyncio.StreamWriter] = {}            # шард → линк; -1 — к координатору
+        self._linked: dict[int, asyncio.Event] = {}
+        self._outbox: dict[int, asyncio.Queue] = {}
+        self._tasks: set[asyncio.Task] = set()
+        self.forwarded = 0
+        self.routed = 0
+
+    # ---------- API для бота ----------
+    def action(self, name: str):
+        def register(fn):
+            self._actions[name] = fn
+            return fn
+        return register
+
+    def bind(self, matchmaker) -> None:
+        self._matchmaker = matchmaker
+
+    def owns(self, user_id: int) -> bool:
+        return self.role == "single" or (self.role == "worker" and shard_of(user_id, self.shards) == self.shard)
+
+    async def call(self, user_id: int, name: str, *args) -> None:
+        if self.owns(user_id):
+            await self._actions[name](*args)
+            return
+        self.forwarded += 1
+        await self._send(shard_of(user_id, self.shards), {"t": "call", "name": name, "args": list(args)})
+
+    async def enqueue(self, ticket) -> None:
+        if self._matchmaker is not None and self.role != "worker":
+            await self._matchmaker.enqueue(ticket)
+            return
+        d = asdict(ticket)
+        d.pop("enqueued_at", None)  # monotonic-время другого процесса координатору ни о чём не говорит
+        await self._send(-1, {"t": "enqueue", "ticket": d})
+
+    def cancel(self, user_id: int) -> None:
+        if self._matchmaker is not None and self.role != "worker":
+            self._matchmaker.cancel(user_id)
+        else:
+            self._post(-1, {"t": "cancel", "uid": user_id})
+
+    # ---------- транспорт ----------
+    def _queue(self, shard: int) -> asyncio.Queue:
+        q = self._outbox.get(shard)
+        if q is None:
+            q = self._outbox[shard] = asyncio.Queue(maxsize=BACKLOG_MAX)
+            self._linked.setdefault(shard, asyncio.Event())
+            self._spawn(self._pump(shard, q))
+        return q
+
+    def _address(self, shard: int, payload: dict) -> tuple[asyncio.Queue, bytes]:
+        """Outbox and line for shard `shard` (-1: the coordinator). Workers always go via the coordinator."""
+        if self.role == "worker":
+            if shard >= 0:
+                payload = {**payload, "to": shard}
+            shard = -1
+        return self._queue(shard), _line(payload)
+
+    async def _send(self, shard: int, payload: dict) -> None:
+        q, data = self._address(shard, payload)
+        await q.put(data)
+
+    def _post(self, shard: int, payload: dict) -> None:
+        """_send for sync callers: if the outbox is full, the put waits in a task."""
+        q, data = self._address(shard, payload)
+        try:
+            q.put_nowait(data)
+        except asyncio.QueueFull:
+            self._spawn(q.put(data))
+
+    def _attach(self, shard: int, writer: asyncio.StreamWriter) -> None:
+        self._links[shard] = writer
+        self._linked.setdefault(shard, asyncio.Event()).set()
+
+    def _detach(self, shard: int, writer: Optional[asyncio.StreamWriter]) -> None:
+        if writer is not None and self._links.get(shard) is writer:
+            del self._links[shard]
+            self._linked[shard].clear()
+
+    async def _pump(self, shard: int, q: asyncio.Queue) -> None:
+        linked = self._linked[shard]
+        while True:
+            data = await q.get()
+            while True:
+                writer = self._links.get(shard)
+                if writer is None or writer.is_closing():
+                    linked.clear()
+                    await linked.wait()
+                    continue
+                try:
+                    writer.write(data)
+                    await writer.drain()
+                    break
+                except ConnectionError:
+                    # линк упал посреди записи: сообщение отправим заново после переподключения
+                    self._detach(shard, writer)
+
+    def _spawn(self, coro) -> None:
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run_action(self, name: str, args: list) -> None:
+        fn = self._actions.get(name)
+        if fn is None:
+            log.error("unknown action %s", name)
+            return
+        try:
+            await fn(*args)
+        except Exception:
+            log.exception("action %s%s failed", name, tuple(args))
+
+    # ---------- воркер ----------
+    async def _connect(self) -> asyncio.StreamReader:
+        for _ in range(RECONNECT_TRIES):
+            try:
+                reader, writer = await asyncio.open_connection(IPC_HOST, IPC_PORT)
+                break
+            except OSError:
+                await asyncio.sleep(0.5)
+        else:
+            raise RuntimeError(f"shard {self.shard}: coordinator at {IPC_HOST}:{IPC_PORT} unreachable")
+        writer.write(_line({"t": "hello", "shard": self.shard}))  # до _attach: hello идёт первым
+        self._attach(-1, writer)
+        return reader
+
+    async def run_worker(self, dp: Dispatcher, bot: Bot) -> None:
+        """
+        Connect to the coordinator and handle routed updates / calls. A dropped link is
+        re-established while the coordinator that started us is alive; outgoing calls
+        wait in the outbox meanwhile.
+        """
+        parent = os.getppid()
+        reader = await self._connect()
+        sem = asyncio.Semaphore(SHARD_CONCURRENCY)
+
+        async def feed(raw: dict) -> None:
+            try:
+                await dp.feed_update(bot, Update.model_validate(raw, context={"bot": bot}))
+            except Exception:
+                log.exception("shard %s: update %s failed", self.shard, raw.get("update_id"))
+            finally:
+                sem.release()
+
+        async def push_metrics() -> None:
+            while True:
+                if -1 in self._links:  # пока линка нет, метрики не копим — следующие будут свежее
+                    self._post(-1, {"t": "metrics", "values": metrics.local()})
+                await asyncio.sleep(METRICS_PUSH)
+
+        await dp.emit_startup(bot=bot)
+        self._spawn(push_metrics())
+        log.info("shard %s/%s online", self.shard, self.shards)
+        try:
+            while True:
+                while line := await reader.readline():
+                    msg = json.loads(line)
+                    if msg["t"] == "update":
+                        await sem.acquire()
+                        self._spawn(feed(msg["u"]))
+                    elif msg["t"] == "call":
+                        self._spawn(self._run_action(msg["name"], msg["args"]))
+                self._detach(-1, self._links.get(-1))
+                if os.getppid() != parent:
+                    break  # координатор умер — новый запустит своих воркеров
+                log.warning("shard %s: coordinator link closed, reconnecting", self.shard)
+                reader = await self._connect()
+        finally:
+            log.warning("shard %s: coordinator link closed", self.shard)
+            await dp.emit_shutdown(bot=bot)
+
+    # ---------- координатор ----------
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        hello = json.loads(await reader.readline() or b'{"t":"eof"}')
+        if hello.get("t") != "hello":
+            writer.close()
+            return
+        shard = int(hello["shard"])
+        self._queue(shard)
+        self._attach(shard, writer)
+        log.info("shard %s connected", shard)
+        try:
+            while line := await reader.readline():
+                msg = json.loads(line)
+                t = msg["t"]
+                if t == "call":
+                    to = msg.pop("to")
+                    await self._queue(to).put(_line(msg))
+                elif t == "enqueue":
+                    await self._matchmaker.enqueue(SearchTicket(**msg["ticket"]))
+                elif t == "cancel":
+                    self._matchmaker.cancel(msg["uid"])
+                elif t == "metrics":
+                    metrics.absorb(f"shard{shard}", msg["values"])
+        finally:
+            self._detach(shard, writer)
+            log.warning("shard %s disconnected", shard)
+
+    async def route(self, update: Update) -> None:
+        """
+        Hand an update to the shard owning its user (shard 0 for user-less updates).
+        Waits while that shard's outbox is full.
+        """
+        uid = update_user_id(update)
+        shard = shard_of(uid, self.shards) if uid is not None else 0
+        body = update.model_dump_json(exclude_none=True, by_alias=True)
+        self.routed += 1
+        await self._queue(shard).put(b'{"t":"update","u":' + body.encode() + b"}\n")
+
+    async def _supervise(self, shard: int, script: str) -> None:
+        env = {**os.environ, "BOT_SHARD_ID": str(shard), "BOT_SHARDS": str(self.shards)}
+        while True:
+            proc = await asyncio.create_subprocess_exec(sys.executable, script, env=env)
+            code = await proc.wait()
+            log.error("shard %s exited with %s, restarting", shard, code)
+            await asyncio.sleep(RESPAWN_DELAY)
+
+    async def _poll(self, dp: Dispatcher, bot: Bot) -> None:
+        offset = None
+        allowed = dp.resolve_used_update_types()
+        while True:
+            try:
+                updates = await bot.get_updates(offset=offset, timeout=POLL_TIMEOUT, allowed_updates=allowed)
+            except Exception:
+                log.exception("get_updates failed")
+                await asyncio.sleep(1)
+                continue
+            for update in updates:
+                await self.route(update)  # ждёт, пока воркер разгребёт очередь
+                offset = update.update_id + 1
+
+    async def run_coordinator(self, dp: Dispatcher, bot: Bot, *, script: str, mode: str = "polling") -> None:
+        """Accept worker links, keep N workers alive and route incoming updates to them."""
+        server = await asyncio.start_server(self._serve, IPC_HOST, IPC_PORT)
+        for shard in range(self.shards):
+            self._spawn(self._supervise(shard, script))
+        log.info("coordinator: %s shards, ipc %s:%s, ingress %s", self.shards, IPC_HOST, IPC_PORT, mode)
+        try:
+            if mode == "webhook":
+                from webhook import WebhookServer
+                hook = WebhookServer(dp, bot, feed=self.route)
+                await hook.start()
+                try:
+                    await asyncio.Event().wait()
+                finally:
+                    await hook.stop()
+            else:
+                await self._poll(dp, bot)
+        finally:
+            server.close()
+            for task in list(self._tasks):
+                task.cancel()
+
+    def stats(self) -> dict:
+        return {
+            "role": self.role,
+            "shard": self.shard,
+            "shards": self.shards,
+            "workers_connected": sum(1 for k in self._links if k >= 0),
+            "backlog": sum(q.qsize() for q in self._outbox.values()),
+            "routed": self.routed,
+            "forwarded": self.forwarded,
+        }
+
+
+cluster = Cluster()
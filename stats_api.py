@@ -1,37 +1,212 @@
-
 # stats_api.py — FastAPI + uvicorn, background server
-import asyncio, logging, webbrowser
-from typing import Any, Dict
+import asyncio, json, logging, os, time, webbrowser
+from typing import Any, AsyncIterator, Dict, Optional
 from fastapi import FastAPI
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi.responses import HTMLResponse, JSONResponse, PlainTextResponse, StreamingResponse
 import uvicorn
 
 from database import get_stats
+from metrics import metrics
 
 log = logging.getLogger("stats")
 app = FastAPI(title="Neverland Stats")
 
+STATS_REFRESH = float(os.getenv("STATS_REFRESH", "15"))  # сек.: как часто пересчитываем статистику в БД
+STREAM_INTERVAL = float(os.getenv("STATS_STREAM_INTERVAL", "1"))  # сек.: как часто /stats/stream шлёт изменения
+STREAM_KEEPALIVE = 15.0
+
+
+class StatsSnapshot:
+    """
+    Last get_stats() result, recomputed every `refresh` seconds by one background task.
+    Requests never hit the database: they get the snapshot (with its age), and only the
+    very first request — or one after the loop has fallen behind by 2x — waits for a
+    refresh, shared by all concurrent callers.
+    """
+
+    def __init__(self, refresh: float = STATS_REFRESH):
+        self.refresh = refresh
+        self.result: Optional[Dict[str, Any]] = None
+        self.taken_at = 0.0           # time.time() снимка
+        self._inflight: Optional[asyncio.Task] = None
+        self._loop_task: Optional[asyncio.Task] = None
+
+    async def _refresh(self) -> Dict[str, Any]:
+        if self._inflight is None or self._inflight.done():
+            self._inflight = asyncio.create_task(get_stats())
+        result = await asyncio.shield(self._inflight)
+        # дневные счётчики после рестарта начинают с нуля — первый снимок из БД их досчитывает,
+        # иначе metrics.snapshot() в dashboard_state затрёт SQL-значение (matches_today) нулём
+        for k, v in (result.get("data") or {}).items():
+            if isinstance(v, (int, float)) and metrics.seed(k, v):
+                log.info("seeded %s=%s from the database", k, v)
+        self.result, self.taken_at = result, time.time()
+        return result
+
+    async def get(self) -> Dict[str, Any]:
+        self.start()
+        if self.result is None or time.time() - self.taken_at > 2 * self.refresh:
+            await self._refresh()
+        return {**self.result, "generated_at": int(self.taken_at), "age_s": round(time.time() - self.taken_at, 1)}
+
+    def start(self) -> None:
+        if self._loop_task is None or self._loop_task.done():
+            self._loop_task = asyncio.create_task(self._run())
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await self._refresh()
+            except Exception:
+                log.exception("stats refresh failed, serving the previous snapshot")
+            await asyncio.sleep(self.refresh)
+
+
+snapshot = StatsSnapshot()
+
+
+def dashboard_state() -> Dict[str, Any]:
+    """Flat {key: value} of everything the dashboard shows: SQL snapshot + live metrics."""
+    state: Dict[str, Any] = {}
+    for k, v in ((snapshot.result or {}).get("data") or {}).items():
+        if isinstance(v, dict):
+            state.update({f"{k}.{sub}": n for sub, n in v.items()})
+        else:
+            state[k] = v
+    state.update(metrics.snapshot())
+    return state
+
+
+class StatsBroadcaster:
+    """
+    One producer for all /stats/stream clients. Every `interval` seconds it diffs
+    dashboard_state() against the previous tick and, if anything changed, encodes the
+    delta once and hands the same bytes to every subscriber. It reads only the
+    in-memory snapshot and metrics, so clients add no database load.
+    A client too slow to keep its queue drained gets a full snapshot instead.
+    """
+
+    def __init__(self, interval: float = STREAM_INTERVAL, queue_size: int = 16):
+        self.interval = interval
+        self.queue_size = queue_size
+        self.state: Dict[str, Any] = {}
+        self._subscribers: set[asyncio.Queue] = set()
+        self._task: Optional[asyncio.Task] = None
+
+    @staticmethod
+    def _event(name: str, payload: Dict[str, Any]) -> bytes:
+        return f"event: {name}\ndata: {json.dumps(payload, separators=(',', ':'))}\n\n".encode()
+
+    def subscribe(self) -> asyncio.Queue:
+        snapshot.start()
+        if self._task is None or self._task.done():
+            self.state = dashboard_state()
+            self._task = asyncio.create_task(self._run())
+        q: asyncio.Queue = asyncio.Queue(maxsize=self.queue_size)
+        q.put_nowait(self._event("snapshot", self.state))
+        self._subscribers.add(q)
+        return q
+
+    def unsubscribe(self, q: asyncio.Queue) -> None:
+        self._subscribers.discard(q)
+
+    def _publish(self, data: bytes) -> None:
+        for q in self._subscribers:
+            try:
+                q.put_nowait(data)
+            except asyncio.QueueFull:
+                while not q.empty():
+                    q.get_nowait()
+                q.put_nowait(self._event("snapshot", self.state))
+
+    async def _run(self) -> None:
+        while self._subscribers or not self.state:
+            await asyncio.sleep(self.interval)
+            try:
+                current = dashboard_state()
+            except Exception:
+                log.exception("stats stream tick failed")
+                continue
+            delta = {k: v for k, v in current.items() if self.state.get(k) != v}
+            self.state = current
+            if delta:
+                self._publish(self._event("delta", delta))
+
+
+broadcaster = StatsBroadcaster()
+
+
+_ROWS = [
+    ("Total users", "users_total", ""),
+    ("Premium active", "premium_users", ""),
+    ("Active chats", "active_chats", ""),
+    ("Searching now", "searching_users", ""),
+    ("Matches today", "matches_today", ""),
+    ("Matches / min", "matches_per_minute", ""),
+    ("Messages relayed", "messages_relayed_per_second", "/s"),
+    ("Send queue", "send_queue", ""),
+]
+
+_LIVE_JS = """
+<script>
+const es = new EventSource("/stats/stream");
+const apply = (e) => {
+  for (const [k, v] of Object.entries(JSON.parse(e.data))) {
+    const el = document.querySelector(`[data-k="${k}"]`);
+    if (el) el.textContent = v;
+  }
+  document.getElementById("status").textContent = "live · " + new Date().toLocaleTimeString();
+};
+es.addEventListener("snapshot", apply);
+es.addEventListener("delta", apply);
+es.onerror = () => { document.getElementById("status").textContent = "reconnecting…"; };
+</script>
+"""
+
 @app.get("/", response_class=HTMLResponse)
 async def index() -> str:
-    stats = await get_stats()
+    await snapshot.get()
+    state = dashboard_state()  # SQL-снимок + счётчики бота из памяти; дальше страница обновляется по SSE
+    rows = "".join(
+        f'<li>{title}: <b data-k="{key}">{state.get(key, 0):g}</b>{unit}</li>' for title, key, unit in _ROWS
+    )
     html = f"""
     <html><head><title>Neverland Stats</title></head>
     <body style="font-family:system-ui;padding:16px;">
       <h1>Neverland — Realtime Stats</h1>
-      <ul>
-        <li>Total users: <b>{stats.get('users_total',0)}</b></li>
-        <li>Premium active: <b>{stats.get('premium_active',0)}</b></li>
-        <li>Active chats: <b>{stats.get('active_chats',0)}</b></li>
-        <li>Matches today: <b>{stats.get('matches_today',0)}</b></li>
-      </ul>
-      <p><a href="/stats">/stats</a> (JSON)</p>
+      <ul>{rows}</ul>
+      <p id="status" style="color:#888">static</p>
+      <p><a href="/stats">/stats</a> (JSON) · <a href="/stats/live">/stats/live</a> · <a href="/metrics">/metrics</a></p>
+      {_LIVE_JS}
     </body></html>
     """
     return html
 
 @app.get("/stats", response_class=JSONResponse)
 async def stats() -> Dict[str, Any]:
-    return await get_stats()
+    return await snapshot.get()
+
+@app.get("/stats/live", response_class=JSONResponse)
+async def stats_live() -> Dict[str, Any]:
+    return {"ok": True, "data": metrics.snapshot(), "generated_at": int(time.time())}
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def prometheus() -> PlainTextResponse:
+    return PlainTextResponse(metrics.prometheus(), media_type="text/plain; version=0.0.4")
+
+@app.get("/stats/stream")
+async def stats_stream() -> StreamingResponse:
+    async def events() -> AsyncIterator[bytes]:
+        q = broadcaster.subscribe()
+        try:
+            while True:
+                try:
+                    yield await asyncio.wait_for(q.get(), STREAM_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    yield b": ping\n\n"  # держим соединение через прокси
+        finally:
+            broadcaster.unsubscribe(q)
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
 
 async def start_stats_server(host: str="127.0.0.1", port: int=8000, open_browser: bool=False):
     config = uvicorn.Config(app, host=host, port=port, loop="asyncio", log_level="info")
@@ -46,6 +221,7 @@ async def start_stats_server(host: str="127.0.0.1", port: int=8000, open_browser
             log.warning("Failed to open browser")
     if open_browser:
         asyncio.create_task(_open())
+    snapshot.start()
     await server.serve()
 
 
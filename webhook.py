@@ -0,0 +1,140 @@
+# webhook.py — приём апдейтов через aiohttp-вебхук вместо long polling (тот же Dispatcher)
+import asyncio
+import hmac
+import logging
+import os
+import secrets
+from typing import Awaitable, Callable, Optional
+
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+
+log = logging.getLogger("webhook")
+
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower()       # polling | webhook
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")                  # публичный https://…/tg/webhook; пусто — setWebhook не зовём
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/tg/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")              # пусто — генерируем и отдаём в setWebhook
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", "1000"))
+WEBHOOK_CONCURRENCY = int(os.getenv("WEBHOOK_CONCURRENCY", "32"))
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+class WebhookServer:
+    """
+    aiohttp endpoint feeding updates into a Dispatcher.
+
+    The handler only checks the secret, parses the update and puts it into a bounded
+    queue, so Telegram gets its 200 right away. When the queue is full the request is
+    answered 503 and Telegram redelivers it later — that is the backpressure.
+    `concurrency` workers drain the queue, which caps handlers running at once.
+    `feed` replaces dp.feed_update when updates are handed elsewhere (shards.py).
+
+    Every request must carry the secret token. Without WEBHOOK_SECRET a random one is
+    generated and registered with setWebhook; without a secret or a URL to register one
+    with, the server refuses to start.
+    """
+
+    def __init__(
+        self,
+        dp: Dispatcher,
+        bot: Bot,
+        *,
+        path: str = WEBHOOK_PATH,
+        secret: str = WEBHOOK_SECRET,
+        url: str = WEBHOOK_URL,
+        queue_size: int = WEBHOOK_QUEUE_SIZE,
+        concurrency: int = WEBHOOK_CONCURRENCY,
+        feed: Optional[Callable[[Update], Awaitable[None]]] = None,
+    ):
+        self.dp = dp
+        self.bot = bot
+        self.path = path
+        self.secret = secret
+        self.url = url
+        if not self.secret:
+            if not url:
+                raise RuntimeError("webhook: set WEBHOOK_SECRET (or WEBHOOK_URL to register a generated one)")
+            self.secret = secrets.token_urlsafe(32)
+            log.info("webhook: WEBHOOK_SECRET not set, registering a generated secret token")
+        self.concurrency = max(1, concurrency)
+        self._feed = feed or (lambda update: dp.feed_update(bot, update))
+        self.queue: asyncio.Queue[Update] = asyncio.Queue(maxsize=max(1, queue_size))
+        self._workers: list[asyncio.Task] = []
+        self._runner: Optional[web.AppRunner] = None
+        self.accepted = 0
+        self.rejected = 0    # очередь полна → 503
+        self.unauthorized = 0
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post(self.path, self.handle)
+        return app
+
+    async def handle(self, request: web.Request) -> web.Response:
+        if not hmac.compare_digest(request.headers.get(SECRET_HEADER, ""), self.secret):
+            self.unauthorized += 1
+            return web.Response(status=401)
+        try:
+            update = Update.model_validate(await request.json(), context={"bot": self.bot})
+        except Exception:
+            return web.Response(status=400)
+        try:
+            self.queue.put_nowait(update)
+        except asyncio.QueueFull:
+            self.rejected += 1
+            return web.Response(status=503)
+        self.accepted += 1
+        return web.Response()
+
+    async def _worker(self) -> None:
+        while True:
+            update = await self.queue.get()
+            try:
+                await self._feed(update)
+            except Exception:
+                log.exception("update %s failed", update.update_id)
+            finally:
+                self.queue.task_done()
+
+    async def start(self, host: str = WEBHOOK_HOST, port: int = WEBHOOK_PORT) -> None:
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+        self._runner = web.AppRunner(self.app())
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        if self.url:
+            await self.bot.set_webhook(
+                self.url,
+                secret_token=self.secret,
+                allowed_updates=self.dp.resolve_used_update_types(),
+            )
+        log.info("webhook listening on %s:%s%s (workers=%s, queue=%s)", host, port, self.path, self.concurrency, self.queue.maxsize)
+
+    async def stop(self, drain_timeout: float = 10.0) -> None:
+        if self._runner:
+            await self._runner.cleanup()  # новых апдейтов больше не принимаем
+            self._runner = None
+        try:
+            await asyncio.wait_for(self.queue.join(), drain_timeout)
+        except asyncio.TimeoutError:
+            log.warning("webhook stop: %s updates left in queue", self.queue.qsize())
+        for w in self._workers:
+            w.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+
+async def run_webhook(dp: Dispatcher, bot: Bot, **kwargs) -> None:
+    """Counterpart of dp.start_polling(bot): serve until cancelled, emitting the same startup/shutdown events."""
+    server = WebhookServer(dp, bot, **kwargs)
+    await dp.emit_startup(bot=bot)
+    await server.start()
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await server.stop()
+        await dp.emit_shutdown(bot=bot)